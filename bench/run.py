@@ -0,0 +1,305 @@
+#
+# run
+# Time the data path on synthetic stations and write the results as JSON.
+#
+#   python -m wrcc.wea_server.bench.run --years 2 --oi 10 -o new.json
+#   python -m wrcc.wea_server.bench.run --years 2 --archive -o packed.json
+#   python -m wrcc.wea_server.bench.run --compare old.json new.json
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import datetime
+import platform
+import argparse
+import subprocess
+import numpy as np
+from .synth import make_station, PCODES
+from .. import settings
+
+STATION = 'bnch'
+
+# The package benchmarked, e.g. wrcc.wea_server.
+PACKAGE = __package__.rsplit('.', 1)[0]
+
+# Run in a new interpreter to time a worker's cold start.
+IMPORT_CODE = "import %(package)s.libwea.products.listers"
+WORKER_CODE = """
+from %(package)s.service.application import create_app
+from %(package)s.libwea.elements import WeaElements
+create_app()
+WeaElements['AVA']
+"""
+
+
+def timeit(func, repeat=5, warmup=1):
+    """
+    Call func warmup times, then time it repeat times.
+    Returns a dict of the min, median and mean seconds.
+    """
+    for i in range(warmup):
+        func()
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return {
+        'min': min(times),
+        'median': float(np.median(times)),
+        'mean': sum(times) / len(times),
+        'repeat': repeat,
+    }
+
+
+def consume(result):
+    "Run a lazy product to the end, as sending it would."
+    if isinstance(result, tuple):  # export (meta, chunks)
+        result = result[1]
+    if hasattr(result, 'next'):
+        for chunk in result:
+            pass
+
+
+def python(code):
+    "Return a function running code in a new interpreter."
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    def run():
+        subprocess.check_call([sys.executable, '-c',
+                               code % {'package': PACKAGE}], env=env)
+    return run
+
+
+def startup_benchmarks(scratch_dir):
+    """
+    Return a list of (name, func) timing imports, a worker's cold
+    start and loading the elements tables, with a snapshot kept in
+    scratch_dir.
+    """
+    from ..libwea import elements
+
+    def parse_elements():
+        sources = elements.source_files()
+        elements.parse_elements(sources[0], sources[1])
+        elements.parse_conversions(sources[2])
+
+    snapshot = os.path.join(scratch_dir, 'elements.snapshot')
+
+    return [
+        ('startup python', python('pass')),
+        ('startup import listers', python(IMPORT_CODE)),
+        ('startup worker', python(WORKER_CODE)),
+        ('startup elements parse', parse_elements),
+        ('startup elements snapshot',
+         lambda: elements.load_tables(snapshot=snapshot)),
+    ]
+
+
+def benchmarks(stn, years, scratch_dir):
+    """
+    Return a list of (name, func) to time over the synthetic station.
+    libwea is imported here, after settings.DATAPATH is set. Files the
+    benchmarks write go in scratch_dir.
+    """
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+    from ..libwea.wea_file import WeaFile
+    from ..libwea.wea_array import WeaArray
+    from ..libwea.utils import filename_from_yearmonth
+    from ..libwea.products import listers
+    from ..service.application import create_app
+    from ..service.cache import response_cache
+
+    last = years[-1]
+    month_file = os.path.join(settings.DATAPATH, stn,
+                              filename_from_yearmonth((last, 6), stn))
+    month = (datetime.datetime(last, 6, 1),
+             datetime.datetime(last, 6, 30, 23, 50))
+    year = (datetime.datetime(last, 1, 1),
+            datetime.datetime(last, 12, 31, 23, 50))
+    everything = (datetime.datetime(years[0], 1, 1),
+                  datetime.datetime(last, 12, 31, 23, 50))
+    day = datetime.datetime(last, 6, 15)
+
+    wea = WeaFile(month_file)
+    pcodes = wea.header['pcodes']
+    wea.close()
+    # AVA if the station has it (--ne 11 or more), as it is converted.
+    element = 'AVA' if 'AVA' in pcodes else pcodes[2]
+
+    def open_file():
+        WeaFile(month_file).close()
+
+    def get_var(sD, eD):
+        return lambda: WeaArray(stn, sD, eD,
+                                units_system='E').get_var(element)
+
+    def lister(func, *args, **kwargs):
+        return lambda: consume(func(*args, **kwargs))
+
+    client = Client(create_app(), BaseResponse)
+    query = '?stn=%s&sD=%s&eD=%s' % (
+        stn, year[0].strftime('%Y-%m-%d'), year[1].strftime('%Y-%m-%d'))
+
+    def endpoint(url, cached=False, headers=None):
+        def get():
+            if not cached:
+                response_cache.clear()
+            response = client.get(url, headers=headers)
+            response.get_data()  # send a streamed body
+            assert response.status_code == 200, url
+        return get
+
+    return startup_benchmarks(scratch_dir) + [
+        ('WeaFile.open', open_file),
+        ('WeaArray.get_var month', get_var(*month)),
+        ('WeaArray.get_var year', get_var(*year)),
+        ('WeaArray.get_var all', get_var(*everything)),
+        ('listers.getData year', lister(listers.getData, stn, *year)),
+        ('listers.getData year E', lister(listers.getData, stn, *year,
+                                          units_system='E')),
+        ('listers.getDataJson year', lister(listers.getDataJson, stn,
+                                            *year)),
+        ('listers.getDataStream year', lister(listers.getDataStream, stn,
+                                              *year)),
+        ('listers.getData year daily', lister(listers.getData, stn, *year,
+                                              interval='daily')),
+        ('listers.getDataExport year bin', lister(listers.getDataExport,
+                                                  stn, *year, format='bin')),
+        ('listers.getDataExport year csv', lister(listers.getDataExport,
+                                                  stn, *year, format='csv')),
+        ('listers.getDataSingleDay', lister(listers.getDataSingleDay, stn,
+                                            day)),
+        ('listers.getMostRecentData', lister(listers.getMostRecentData,
+                                             stn)),
+        ('listers.getSummary all daily', lister(listers.getSummary, stn,
+                                                *everything)),
+        ('listers.getStnDates', lister(listers.getStnDates, stn)),
+        ('listers.getStats year', lister(listers.getStats, stn, *year)),
+        ('listers.getStats year E', lister(listers.getStats, stn, *year,
+                                           units_system='E')),
+        ('GET /getData year', endpoint('/getData' + query)),
+        ('GET /getData year cached', endpoint('/getData' + query, True)),
+        ('GET /getData year stream', endpoint('/getData' + query +
+                                              '&stream=1')),
+        ('GET /getData year csv', endpoint('/getData' + query +
+                                           '&format=csv')),
+        ('GET /getData year gzip', endpoint('/getData' + query,
+            headers={'Accept-Encoding': 'gzip'})),
+        ('GET /getMostRecentData', endpoint('/getMostRecentData?stn=' + stn)),
+        ('GET /getSummary year', endpoint('/getSummary' + query)),
+        ('GET /getStats year', endpoint('/getStats' + query)),
+    ]
+
+
+def run(years, oi, ne, missing, repeat, data_dir=None, only=None,
+        packed=False):
+    """
+    Generate a station (unless data_dir already holds one), pack its
+    closed months into an archive if packed, and time each benchmark.
+    Returns the results dict written as JSON.
+    """
+    tmp = tempfile.mkdtemp(prefix='weabench')
+    if data_dir is None:
+        data_dir = tmp
+    try:
+        if not os.path.isdir(os.path.join(data_dir, STATION)):
+            make_station(data_dir, STATION, years, oi, ne, missing)
+        settings.DATAPATH = data_dir
+        if packed:
+            from ..libwea.archive import pack_station
+            pack_station(STATION)
+        results = {}
+        for name, func in benchmarks(STATION, years, tmp):
+            if only and only not in name:
+                continue
+            results[name] = timeit(func, repeat)
+            sys.stderr.write("%-36s %9.4fs\n" % (name,
+                                                 results[name]['median']))
+    finally:
+        shutil.rmtree(tmp)
+    return {
+        'config': {
+            'years': list(years),
+            'oi': oi,
+            'ne': ne,
+            'missing': missing,
+            'repeat': repeat,
+            'archive': packed,
+        },
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'time': datetime.datetime.now().isoformat(),
+        'results': results,
+    }
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Print each benchmark's median time in new relative to old.
+    Returns the names that are slower by more than threshold.
+    """
+    slower = []
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        a = old['results'][name]['median']
+        b = new['results'][name]['median']
+        ratio = b / a if a else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            slower.append(name)
+            flag = '  SLOWER'
+        print "%-36s %9.4fs %9.4fs %6.2fx%s" % (name, a, b, ratio, flag)
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the data path on a synthetic station.")
+    parser.add_argument('--years', type=int, default=2,
+                        help="years of data to generate")
+    parser.add_argument('--oi', type=int, default=10,
+                        help="observation interval in minutes")
+    parser.add_argument('--ne', type=int, default=22,
+                        help="number of elements, 3 to %d" % len(PCODES))
+    parser.add_argument('--missing', type=float, default=0.01,
+                        help="fraction of values missing")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--data', help="use or keep the station here")
+    parser.add_argument('--archive', action='store_true',
+                        help="pack the station's closed months first")
+    parser.add_argument('--only', help="run benchmarks with this in the name")
+    parser.add_argument('-o', '--output', help="write results JSON here")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two results files")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    if not 3 <= args.ne <= len(PCODES):
+        parser.error("--ne must be from 3 to %d" % len(PCODES))
+
+    if args.compare:
+        old, new = [json.load(open(f)) for f in args.compare]
+        return 1 if compare(old, new, args.threshold) else 0
+
+    this_year = datetime.date.today().year
+    years = range(this_year - args.years, this_year)
+    results = run(years, args.oi, args.ne, args.missing, args.repeat,
+                  args.data, args.only, args.archive)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print text
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#
+# synth
+# Synthetic stations, written in the .wea layout WeaFile reads.
+#
+
+import os
+import struct
+import calendar
+import datetime
+import numpy as np
+from ..libwea.wea_file import HEADER_FORMAT
+from ..libwea.utils import filename_from_yearmonth
+from ..settings import MISSINGS
+
+# Elements of a typical station, in file order. The first ne are used.
+PCODES = ('DAY', 'TIM', 'RAD', 'MWS', 'MVM', 'MWD', 'SDD', 'MXW', 'MXA',
+          'MNA', 'AVA', 'MXR', 'MNR', 'AVR', 'ATM', 'PRE', 'PTL', 'XBT',
+          'NBT', 'BAT', 'PAN', 'SID')
+
+# Plausible ranges of generated values, by pcode. Others use (0, 100).
+RANGES = {
+    'RAD': (0, 1200),
+    'MWS': (0, 15),
+    'MWD': (0, 360),
+    'AVA': (-20, 40),
+    'ATM': (800, 1050),
+    'PRE': (0, 2),
+}
+
+
+def month_block(year, month, oi=10, pcodes=PCODES, missing=0.0, seed=None):
+    """
+    Return the data rows of a month as a '<f4' array, with DAY and TIM
+    filled in and a fraction missing of the other values missing.
+    """
+    days = calendar.monthrange(year, month)[1]
+    minutes = np.arange(days * 1440 // oi) * oi
+    first_day = datetime.date(year, month, 1).timetuple().tm_yday
+    if seed is None:
+        seed = year * 100 + month
+    rng = np.random.RandomState(seed)
+
+    block = np.empty((len(minutes), len(pcodes)), dtype='<f4')
+    for j, pcode in enumerate(pcodes):
+        if pcode == 'DAY':
+            block[:, j] = first_day + minutes // 1440
+        elif pcode == 'TIM':
+            block[:, j] = (minutes % 1440) // 60 * 100 + minutes % 60
+        else:
+            low, high = RANGES.get(pcode, (0, 100))
+            block[:, j] = np.round(rng.uniform(low, high, len(minutes)), 2)
+            if missing:
+                block[rng.random_sample(len(minutes)) < missing, j] = \
+                    MISSINGS[0]
+    return block
+
+
+def write_wea(filename, year, month, oi=10, pcodes=PCODES, missing=0.0,
+              seed=None, rgt=83, wsh=20):
+    "Write a synthetic month file for (year, month) to filename."
+    block = month_block(year, month, oi, pcodes, missing, seed)
+    days = calendar.monthrange(year, month)[1]
+    with open(filename, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, 1, float(days * 1440), oi,
+                            len(pcodes), rgt, wsh, *([0] * 8)))
+        f.write(''.join(pcodes))
+        f.write(block.tobytes())
+
+
+def make_station(data_dir, stn_id, years, oi=10, ne=len(PCODES),
+                 missing=0.0):
+    """
+    Write a month file for each month of years for stn_id under
+    data_dir, using the first ne of PCODES. Returns the station's
+    directory.
+    """
+    if not 2 <= ne <= len(PCODES):
+        raise ValueError("ne must be from 2 to %d" % len(PCODES))
+    stn_dir = os.path.join(data_dir, stn_id)
+    if not os.path.isdir(stn_dir):
+        os.makedirs(stn_dir)
+    for year in years:
+        for month in range(1, 13):
+            filename = os.path.join(
+                stn_dir, filename_from_yearmonth((year, month), stn_id))
+            write_wea(filename, year, month, oi, PCODES[:ne], missing)
+    return stn_dir
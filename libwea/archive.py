@@ -0,0 +1,204 @@
+#
+# archive
+# A station's closed months packed into one file.
+#
+# The file starts with MAGIC, the length of a JSON directory and the
+# directory itself, a list with, for each month, its (year, month),
+# header, the offset and number of its rows and the stamp of the .wea
+# file it was packed from. The rows of each month follow, as '<f4'
+# aligned to 8 bytes. The whole file is mapped once.
+#
+#   python -m wrcc.wea_server.libwea.archive STN [STN ...]
+#
+
+import os
+import sys
+import json
+import struct
+import datetime
+import numpy as np
+from numpy import array
+from wea_file import WeaFile
+from file_cache import WeaFileCache, open_weafile
+from utils import filename_from_yearmonth
+from .. import settings
+
+MAGIC = 'WEAARCH1'
+PREFIX_FORMAT = '<8sI'
+ALIGN = 8
+
+# Read closed months from a station's archive when it has one.
+ENABLED = getattr(settings, 'WEA_ARCHIVE', True)
+
+
+def archive_filename(stn_id, data_dir=None):
+    "Return the name of the archive of stn_id."
+    stn_id = str(stn_id).lower()
+    if data_dir is None:
+        data_dir = os.path.join(settings.DATAPATH, stn_id)
+    return os.path.join(data_dir, "%s.archive" % stn_id)
+
+
+def _aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _read_header(f, filename):
+    "Return the directory at the start of the open archive f."
+    prefix = f.read(struct.calcsize(PREFIX_FORMAT))
+    if len(prefix) < struct.calcsize(PREFIX_FORMAT):
+        raise IOError("Truncated archive %s" % filename)
+    magic, length = struct.unpack(PREFIX_FORMAT, prefix)
+    if magic != MAGIC:
+        raise IOError("Not an archive: %s" % filename)
+    try:
+        months = json.loads(f.read(length))
+    except ValueError:
+        raise IOError("Bad archive directory in %s" % filename)
+    directory = {}
+    for m in months:
+        header = dict((str(k), v) for k, v in m['header'].items())
+        header['pcodes'] = tuple(str(p) for p in header['pcodes'])
+        ym = tuple(m['ym'])
+        directory[ym] = {
+            'ym': ym,
+            'header': header,
+            'offset': m['offset'],
+            'rows': m['rows'],
+            'stamp': tuple(m['stamp']),
+        }
+    return directory
+
+
+def read_directory(filename):
+    """
+    Return the month directory of the archive filename, a dict of
+    (year, month) to a dict of header, offset, rows and stamp.
+    """
+    with open(filename, 'rb') as f:
+        return _read_header(f, filename)
+
+
+class ArchiveMonth(WeaFile):
+    "A month of an archive, read like the .wea file it was packed from."
+
+    def __init__(self, filename, header, data):
+        WeaFile.__init__(self, filename, readdata=False, header=header)
+        self.data = data
+        self.years = array([self.yearmonth()[0]] * len(data))
+
+    def close(self):
+        pass  # the archive owns the mapping
+
+    def __repr__(self):
+        return "<ArchiveMonth %s>" % self.filename
+
+
+class StationArchive(object):
+    """
+    The months of an archive file, each a view into a single
+    read-only mapping of the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data_dir = os.path.dirname(filename)
+        self.stn_id = os.path.basename(filename).split('.')[0]
+        with open(filename, 'rb') as f:
+            self.directory = _read_header(f, filename)
+        self._map = np.memmap(filename, dtype=np.uint8, mode='r')
+        self._months = {}
+
+    def __repr__(self):
+        return "<StationArchive %s>" % self.filename
+
+    def month(self, ym):
+        "Return the ArchiveMonth of the (year, month) tuple ym."
+        wea = self._months.get(ym)
+        if wea is None:
+            m = self.directory[ym]
+            ne = m['header']['ne']
+            data = np.ndarray((m['rows'], ne), dtype='<f4',
+                              buffer=self._map, offset=m['offset'])
+            filename = os.path.join(
+                self.data_dir, filename_from_yearmonth(ym, self.stn_id))
+            wea = self._months[ym] = ArchiveMonth(filename, m['header'], data)
+        return wea
+
+    def close(self):
+        self._months = {}
+        self._map = None
+
+
+# Archives opened by this process, one mapping per station.
+archive_cache = WeaFileCache(loader=StationArchive)
+
+
+def open_entry(entry):
+    """
+    Return the WeaFile of a station index entry, from the station's
+    archive if the entry came from there.
+    """
+    if 'archive' in entry:
+        archive = archive_cache.get(entry['archive'],
+                                    stamp=entry['archive_stamp'])
+        return archive.month(entry['ym'])
+    return open_weafile(entry['filename'], stamp=entry['stamp'],
+                        header=entry['header'])
+
+
+def pack_station(stn_id, before=None):
+    """
+    Pack every month of stn_id before the (year, month) before into
+    the station's archive, replacing any archive there. before defaults
+    to the current month, which is left in its .wea file. Returns the
+    number of months packed.
+    """
+    from station_index import get_station_index
+    if before is None:
+        today = datetime.date.today()
+        before = (today.year, today.month)
+    index = get_station_index(stn_id)
+    months = [ym for ym in index.months() if ym < tuple(before)]
+    entries = index.plan(months, refresh=True)  # pack edited months
+    weafiles = [open_entry(entry) for entry in entries]
+
+    directory = []
+    for ym, entry, wea in zip(months, entries, weafiles):
+        header = dict(wea.header)
+        header['pcodes'] = list(header['pcodes'])
+        directory.append({
+            'ym': list(ym),
+            'header': header,
+            'offset': 0,
+            'rows': len(wea.data),
+            'stamp': list(entry['stamp']),
+        })
+    # Offsets depend on the length of the directory holding them, so
+    # size it with placeholders as wide as any offset can be.
+    start = struct.calcsize(PREFIX_FORMAT)
+    for m in directory:
+        m['offset'] = 10 ** 15
+    size = _aligned(start + len(json.dumps(directory)))
+    for m in directory:
+        m['offset'] = size
+        size = _aligned(size + m['rows'] * m['header']['ne'] * 4)
+    text = json.dumps(directory)
+    text += ' ' * (directory[0]['offset'] - start - len(text)
+                   if directory else 0)
+
+    filename = archive_filename(stn_id, index.data_dir)
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(struct.pack(PREFIX_FORMAT, MAGIC, len(text)))
+        f.write(text)
+        for m, wea in zip(directory, weafiles):
+            f.write('\0' * (m['offset'] - f.tell()))
+            f.write(np.ascontiguousarray(wea.data, dtype='<f4').tobytes())
+    os.rename(tmp, filename)
+    return len(directory)
+
+
+if __name__ == '__main__':
+    for stn_id in sys.argv[1:]:
+        print "%s: %d months" % (stn_id, pack_station(stn_id))
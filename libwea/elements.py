@@ -1,8 +1,20 @@
 #
 # WeaBase elements and unit conversions.
 #
+# The element files are parsed on first access to WeaElements or
+# Conversions. If ELEMENTS_SNAPSHOT is set, the result is kept in that
+# file and used until any of them changes.
+#
+
+import os
+import marshal
+import tempfile
+import threading
+from collections import Mapping
+from .. import settings
 
-from ..settings import ELEMENTS_FILE, WEA_ELEMENTS_FILE, WEA_ELEMENTS2_FILE
+# Bump when the layout of the parsed tables changes.
+SNAPSHOT_VERSION = 1
 
 # Define display formats
 DEFAULT_FORMAT = "%f"
@@ -19,55 +31,172 @@ FORMATS = {
     10: "%.3f",
 }
 
-WeaElements = {}
-elements_file = open(ELEMENTS_FILE, 'r')
-header = elements_file.readline()
-for line in [l.strip() for l in elements_file.readlines()]:
-    pcode, name, scale_max, scale_min, unused, fmt = [i.strip() for i in line.split(',')]
-    name = name[1:-1].strip()  # remove " surround name
-    elem = {
-        "name": name,
-        "scaling_max": float(scale_max),
-        "scaling_min": float(scale_min)
-    }
 
-    # Determine display format
-    try:
-        elem["format"] = FORMATS[int(fmt)]
-    except KeyError:
-        elem["format"] = DEFAULT_FORMAT
+def parse_elements(elements_filename, wea_elements_filename):
+    "Parse the element files into the WeaElements dict."
+    WeaElements = {}
+    elements_file = open(elements_filename, 'r')
+    header = elements_file.readline()
+    for line in [l.strip() for l in elements_file.readlines()]:
+        pcode, name, scale_max, scale_min, unused, fmt = [i.strip() for i in line.split(',')]
+        name = name[1:-1].strip()  # remove " surround name
+        elem = {
+            "name": name,
+            "scaling_max": float(scale_max),
+            "scaling_min": float(scale_min)
+        }
+
+        # Determine display format
+        try:
+            elem["format"] = FORMATS[int(fmt)]
+        except KeyError:
+            elem["format"] = DEFAULT_FORMAT
+
+        WeaElements[pcode] = elem
+    elements_file.close()
+
+    # Supplement WeaElements with info from wea_elements.dat
+    wea_elements_file = open(wea_elements_filename, 'r')
+    header = wea_elements_file.readline()
+    for line in [l.strip() for l in wea_elements_file.readlines()]:
+        try:
+            pcode, units, desc1, desc2, desc_long = line.split(',')
+        except ValueError:
+            continue
+        pcode = pcode.strip()
+        if not pcode in WeaElements:
+            WeaElements[pcode] = {}  # noqa
+        WeaElements[pcode].update({
+            "units": units.strip(),
+            "name": desc_long
+        })
+    wea_elements_file.close()
+    return WeaElements
+
 
-    WeaElements[pcode] = elem
-elements_file.close()
+def parse_conversions(wea_elements2_filename):
+    "Parse wea_elements2.dat into the Conversions dict."
+    Conversions = {}
+    wea_elements2_file = open(wea_elements2_filename, 'r')
+    header = wea_elements2_file.readline()
+    for line in [l.strip() for l in wea_elements2_file.readlines()]:
+        system, units1, units2, multiplier, offset = line.split(',')
+        # Convert units1 to system by muliplying multiplier and adding
+        # offset, resulting in units2
+        Conversions[(units1.strip(), system.strip())] = (float(multiplier), float(offset), units2.strip())
+    wea_elements2_file.close()
+    return Conversions
 
 
-# Supplement WeaElements with info from wea_elements.dat
-wea_elements_file = open(WEA_ELEMENTS_FILE, 'r')
-header = wea_elements_file.readline()
-for line in [l.strip() for l in wea_elements_file.readlines()]:
+def source_files():
+    "The element files named in settings, in the order they are parsed."
+    return (settings.ELEMENTS_FILE, settings.WEA_ELEMENTS_FILE,
+            settings.WEA_ELEMENTS2_FILE)
+
+
+def snapshot_filename():
+    """
+    Where the parsed tables are kept: ELEMENTS_SNAPSHOT, or None to
+    keep no snapshot. The file must be in a directory only the service
+    can write, since the tables are read from it as they are.
+    """
+    return getattr(settings, 'ELEMENTS_SNAPSHOT', None) or None
+
+
+def _stamps(sources):
+    stamps = []
+    for filename in sources:
+        st = os.stat(filename)
+        stamps.append((filename, st.st_mtime, st.st_size))
+    return stamps
+
+
+def load_tables(sources=None, snapshot=None):
+    """
+    Return (WeaElements, Conversions) parsed from sources, read from
+    the snapshot if it was made from sources as they are now, and
+    otherwise parsed and saved to the snapshot. snapshot defaults to
+    snapshot_filename(); with none, the tables are just parsed.
+    """
+    if sources is None:
+        sources = source_files()
+    if snapshot is None:
+        snapshot = snapshot_filename()
+    if snapshot is None:
+        return (parse_elements(sources[0], sources[1]),
+                parse_conversions(sources[2]))
+    stamps = _stamps(sources)
+    try:
+        with open(snapshot, 'rb') as f:
+            saved = marshal.load(f)
+        if saved['version'] == SNAPSHOT_VERSION and saved['stamps'] == stamps:
+            return saved['elements'], saved['conversions']
+    except (IOError, EOFError, ValueError, TypeError, KeyError):
+        pass
+
+    tables = (parse_elements(sources[0], sources[1]),
+              parse_conversions(sources[2]))
+    tmp = None
     try:
-        pcode, units, desc1, desc2, desc_long = line.split(',')
-    except ValueError:
-        continue
-    pcode = pcode.strip()
-    if not pcode in WeaElements:
-        WeaElements[pcode] = {}  # noqa
-    WeaElements[pcode].update({
-        "units": units.strip(),
-        "name": desc_long
-    })
-wea_elements_file.close()
-
-
-Conversions = {}
-wea_elements2_file = open(WEA_ELEMENTS2_FILE, 'r')
-header = wea_elements2_file.readline()
-for line in [l.strip() for l in wea_elements2_file.readlines()]:
-    system, units1, units2, multiplier, offset = line.split(',')
-    # Convert units1 to system by muliplying multiplier and adding
-    # offset, resulting in units2
-    Conversions[(units1.strip(), system.strip())] = (float(multiplier), float(offset), units2.strip())
-wea_elements2_file.close()
+        # A new file of our own, never one put there by someone else.
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(snapshot),
+                                   suffix='.tmp',
+                                   dir=os.path.dirname(snapshot) or '.')
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump({
+                'version': SNAPSHOT_VERSION,
+                'stamps': stamps,
+                'elements': tables[0],
+                'conversions': tables[1],
+            }, f)
+        os.rename(tmp, snapshot)
+    except (IOError, OSError):
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)  # parsed again next time
+    return tables
+
+
+_tables = None
+_tables_lock = threading.Lock()
+
+
+def get_tables():
+    "Return (WeaElements, Conversions), loading them on first use."
+    global _tables
+    if _tables is None:
+        with _tables_lock:
+            if _tables is None:
+                _tables = load_tables()
+    return _tables
+
+
+class LazyTable(Mapping):
+    "A read-only view of one of the tables, loaded on first access."
+
+    def __init__(self, which):
+        self.which = which
+
+    def _table(self):
+        return get_tables()[self.which]
+
+    def __getitem__(self, key):
+        return self._table()[key]
+
+    def __contains__(self, key):
+        return key in self._table()
+
+    def __iter__(self):
+        return iter(self._table())
+
+    def __len__(self):
+        return len(self._table())
+
+    def __repr__(self):
+        return repr(self._table())
+
+
+WeaElements = LazyTable(0)
+Conversions = LazyTable(1)
 
 
 """
@@ -0,0 +1,139 @@
+#
+# file_cache
+# A process-wide cache of opened WeaFile objects.
+#
+
+import os
+import threading
+from collections import OrderedDict
+from wea_file import WeaFile
+from metrics import Callback
+from .. import settings
+
+# Bounds on what the cache keeps open. Override in settings.py.
+MAX_FILES = getattr(settings, 'WEAFILE_CACHE_MAX_FILES', 256)
+MAX_BYTES = getattr(settings, 'WEAFILE_CACHE_MAX_BYTES', 1024 * 1024 * 1024)
+
+
+def file_stamp(filename):
+    """
+    Return the (mtime, size) of filename, used to tell if a cached
+    object is still current. Raises IOError if filename is missing.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError, e:
+        raise IOError(e.errno, e.strerror, filename)
+    return (st.st_mtime, st.st_size)
+
+
+class WeaFileCache(object):
+    """
+    A thread-safe, least recently used cache of objects keyed by path.
+
+    Each lookup stats the file and reloads it if its mtime or size
+    changed, so the current, still-growing month is always fresh while
+    closed months are opened once. The cache is bounded by number of
+    open files and by mapped bytes.
+    """
+
+    def __init__(self, max_files=MAX_FILES, max_bytes=MAX_BYTES,
+                 loader=WeaFile):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self._entries = OrderedDict()  # filename -> (stamp, obj)
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filename, stamp=None, **kwargs):
+        """
+        Return the loaded object for filename, opening it if it
+        is not cached or has changed on disk. A stamp the caller just
+        took saves another stat. Extra kwargs are passed to the loader.
+        """
+        if stamp is None:
+            stamp = file_stamp(filename)
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is not None:
+                if entry[0] == stamp:
+                    self._entries[filename] = entry  # most recently used
+                    self.hits += 1
+                    return entry[1]
+                self._discard(entry)
+                self.reloads += 1
+            self.misses += 1
+
+        # Open outside the lock so slow disks don't serialize requests.
+        obj = self.loader(filename, **kwargs)
+
+        with self._lock:
+            old = self._entries.pop(filename, None)
+            if old is not None:
+                self._discard(old)
+            self._entries[filename] = (stamp, obj)
+            self.nbytes += stamp[1]
+            self._evict()
+        return obj
+
+    def _discard(self, entry):
+        "Forget entry and close its file. Call with the lock held."
+        self.nbytes -= entry[0][1]
+        close = getattr(entry[1], 'close', None)
+        if close is not None:
+            close()
+
+    def _evict(self):
+        "Drop least recently used entries until within bounds."
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_files or
+                self.nbytes > self.max_bytes):
+            filename, entry = self._entries.popitem(last=False)
+            self._discard(entry)
+            self.evictions += 1
+
+    def clear(self):
+        "Close and forget every cached file."
+        with self._lock:
+            while self._entries:
+                filename, entry = self._entries.popitem()
+                self._discard(entry)
+
+    def stats(self):
+        "Return a dict of cache counters."
+        with self._lock:
+            return {
+                'files': len(self._entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'evictions': self.evictions,
+            }
+
+
+# The cache shared by every request in this process.
+weafile_cache = WeaFileCache()
+
+
+Callback('wea_open_files', 'Data files held open by the file cache.',
+         lambda: weafile_cache.stats()['files'])
+Callback('wea_mapped_bytes', 'Bytes of data files mapped by the file cache.',
+         lambda: weafile_cache.stats()['bytes'])
+Callback('wea_file_cache_lookups_total', 'File cache lookups, by result.',
+         lambda: dict(((k,), weafile_cache.stats()[k])
+                      for k in ('hits', 'misses', 'reloads')),
+         labels=('result',), kind='counter')
+
+
+def open_weafile(filename, stamp=None, header=None):
+    "Return a WeaFile for filename from the shared cache."
+    return weafile_cache.get(filename, stamp=stamp, header=header)
@@ -0,0 +1,89 @@
+#
+# latest
+# Tracks the most recent valid row of each station.
+#
+
+import threading
+from archive import open_entry
+from station_index import get_station_index
+
+
+class LatestTracker(object):
+    """
+    Remembers, per month file read, its stamp (mtime, size), number
+    of rows and the last row in it with valid data.
+
+    An unchanged file is answered without reading it. When a file
+    only grows, only the appended rows are scanned. A month without
+    any valid rows yet falls back to the month before it.
+    """
+
+    def __init__(self):
+        self.known = {}  # filename -> (stamp, rows, row)
+        self._lock = threading.Lock()
+
+    def _scan(self, entry):
+        """
+        Return (wea, row) for the last valid row in the month file of
+        index entry, where row is None if the file has none.
+        """
+        wea = open_entry(entry)
+        with self._lock:
+            known = self.known.get(entry['filename'])
+        if known is not None:
+            stamp, rows, row = known
+            if stamp == entry['stamp']:
+                return wea, row
+            if stamp[1] < entry['stamp'][1] and rows <= len(wea.data):
+                # Appended to: only the new rows can hold a later row.
+                new_row = wea.last_valid_row(start=rows)
+                if new_row is not None:
+                    row = new_row
+                self._remember(entry, len(wea.data), row)
+                return wea, row
+        row = wea.last_valid_row()
+        self._remember(entry, len(wea.data), row)
+        return wea, row
+
+    def _remember(self, entry, rows, row):
+        with self._lock:
+            self.known[entry['filename']] = (entry['stamp'], rows, row)
+
+    def latest(self, stn_id, ym=None):
+        """
+        Return (wea, row) for the most recent valid row of stn_id,
+        searching back from the (year, month) ym, or from the latest
+        month. Raises IOError if there is no valid row.
+        """
+        wea, row, entries = self._search(stn_id, ym)
+        return wea, row
+
+    def entries(self, stn_id, ym=None):
+        """
+        Return the index entries of the months latest(stn_id, ym) reads:
+        the one it finds a row in, and every later month searched.
+        """
+        return self._search(stn_id, ym)[2]
+
+    def _search(self, stn_id, ym=None):
+        stn_id = str(stn_id).lower()
+        index = get_station_index(stn_id)
+        months = index.months()
+        if ym is not None:
+            months = [m for m in months if m <= tuple(ym)]
+        entries = []
+        for ym in reversed(months):
+            entry = index.entry(ym)
+            entries.append(entry)
+            wea, row = self._scan(entry)
+            if row is not None:
+                return wea, row, entries
+        raise IOError("No data available for %s" % stn_id)
+
+    def clear(self):
+        with self._lock:
+            self.known.clear()
+
+
+# Latest rows seen by this process.
+latest_tracker = LatestTracker()
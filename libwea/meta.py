@@ -5,7 +5,8 @@
 
 import os
 import datetime
-from utils import yearmonth_from_filename, is_valid_filename, days_in_month
+from utils import days_in_month
+from station_index import get_station_index
 from ..settings import DATAPATH
 
 class WeaMeta(object):
@@ -17,11 +18,7 @@ class WeaMeta(object):
         """
         Return a list of dates (year/month) that this stn has data files.
         """
-        filenames = os.listdir(self.data_dir)
-        dates = [yearmonth_from_filename(f)
-                for f in filenames if is_valid_filename(f, self.stn_id)]
-        dates.sort()
-        return dates
+        return get_station_index(self.stn_id).months()
 
     def get_latest_month(self):
         dates = self.get_date_list()
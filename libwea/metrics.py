@@ -0,0 +1,179 @@
+#
+# metrics
+# Counters and timings exposed in the Prometheus text format.
+#
+
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+from inspect import isgeneratorfunction
+from .. import settings
+
+# When False, timed() leaves functions as they are and nothing is
+# counted, so instrumentation costs nothing.
+ENABLED = getattr(settings, 'METRICS_ENABLED', True)
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Every metric, in the order they are rendered.
+registry = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, str(v).replace('"', '\\"'))
+                             for n, v in zip(names, values))
+
+
+class Counter(object):
+    "A count per combination of label values, that only goes up."
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self.values[label_values] = \
+                self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _labels(self.labels, k), v)
+                    for k, v in sorted(self.values.items())]
+
+
+class Histogram(object):
+    "Observed values counted in BUCKETS, per combination of label values."
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            v = self.values.get(label_values)
+            if v is None:
+                v = self.values[label_values] = \
+                    [[0] * (len(self.buckets) + 1), 0.0, 0]
+            v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2]))
+                           for k, v in self.values.items())
+        for k, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                out.append((self.name + '_bucket',
+                            _labels(self.labels + ('le',), k + (bound,)),
+                            cumulative))
+            out.append((self.name + '_sum', _labels(self.labels, k), total))
+            out.append((self.name + '_count', _labels(self.labels, k), count))
+        return out
+
+
+class Callback(object):
+    """
+    A metric read when rendered: func returns a value, or a dict of
+    label value tuples to values.
+    """
+
+    def __init__(self, name, help, func, labels=(), kind='gauge'):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labels = tuple(labels)
+        self.kind = kind
+        registry.append(self)
+
+    def samples(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            return [(self.name, '', values)]
+        return [(self.name, _labels(self.labels, k), v)
+                for k, v in sorted(values.items())]
+
+
+# Time spent in each stage of serving data.
+stage_seconds = Histogram('wea_stage_seconds',
+                          'Time spent in each stage of serving data.',
+                          ('stage',))
+
+
+def timed(stage):
+    """
+    Decorate a function to observe its run time in stage_seconds.
+    A generator's time is summed over the items it yields.
+    Does nothing if metrics are disabled.
+    """
+    def decorate(f):
+        if not ENABLED:
+            return f
+
+        if isgeneratorfunction(f):
+            @wraps(f)
+            def timed_gen(*args, **kwargs):
+                # Time only the generator's own work, not its consumer's.
+                elapsed = 0.0
+                gen = f(*args, **kwargs)
+                try:
+                    while True:
+                        start = time.time()
+                        try:
+                            item = next(gen)
+                        finally:
+                            elapsed += time.time() - start
+                        yield item
+                except StopIteration:
+                    pass
+                finally:
+                    stage_seconds.observe(elapsed, stage)
+            return timed_gen
+
+        @wraps(f)
+        def timed_f(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                stage_seconds.observe(time.time() - start, stage)
+        return timed_f
+    return decorate
+
+
+def _format_value(v):
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+
+def render():
+    "Return every metric in the Prometheus text exposition format."
+    lines = []
+    for metric in registry:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append('%s%s %s' % (name, labels, _format_value(value)))
+    return '\n'.join(lines) + '\n'
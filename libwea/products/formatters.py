@@ -0,0 +1,142 @@
+# Batch formatting of data columns for output.
+# Each column is formatted with a single string operation
+# instead of one Python format per value.
+# The binary and CSV writers consume a block one month at a time.
+
+import json
+import struct
+from cStringIO import StringIO
+import numpy as np
+from ...libwea.utils import missing_mask
+from ...libwea.metrics import timed
+
+# Output formats other than JSON, and their mimetypes.
+EXPORT_FORMATS = {
+    'bin': 'application/octet-stream',
+    'npy': 'application/octet-stream',
+    'npz': 'application/octet-stream',
+    'csv': 'text/csv',
+}
+
+
+def _format_valid(values, fmt, mask):
+    """
+    Return a list of fmt applied to each value of values not in mask,
+    using a single string format over the whole column.
+    """
+    valid = values[~mask].tolist()
+    if not valid:
+        return []
+    return ("\n".join([fmt] * len(valid)) % tuple(valid)).split("\n")
+
+
+@timed('format')
+def format_column(values, fmt, missing=None):
+    """
+    Return a list with each value of the 1-D array values formatted
+    with fmt, and missing in place of missing values.
+    """
+    mask = missing_mask(values)
+    values = np.ma.getdata(values)
+    out = np.empty(len(values), dtype=object)
+    out[~mask] = _format_valid(values, fmt, mask)
+    if missing is not None:
+        out[mask] = missing
+    return out.tolist()
+
+
+@timed('format')
+def format_column_json(values, fmt):
+    """
+    Return the comma separated items of a JSON list holding each value
+    of the 1-D array values formatted with fmt as a string, and null in
+    place of missing values. The text is what json.dumps would produce
+    for format_column(values, fmt), without its brackets.
+    """
+    if not len(values):
+        return ''
+    mask = missing_mask(values)
+    values = np.ma.getdata(values)
+    template = np.empty(len(values), dtype=object)
+    template[:] = '"%s"' % fmt
+    template[mask] = 'null'
+    valid = values[~mask].tolist()
+    return ', '.join(template.tolist()) % tuple(valid)
+
+
+@timed('serialize')
+def _float32_bytes(chunk):
+    "Return the rows of chunk as little-endian float32 bytes."
+    return np.ma.getdata(chunk).astype('<f4').tobytes()
+
+
+def iter_bin(meta, chunks):
+    """
+    Yield a binary export: a little-endian unsigned int giving the
+    length of a JSON header, the JSON of meta, then the rows of chunks
+    as little-endian float32 in row-major order.
+    """
+    header = json.dumps(meta)
+    yield struct.pack('<I', len(header)) + header
+    for chunk in chunks:
+        yield _float32_bytes(chunk)
+
+
+def iter_npy(shape, chunks):
+    """
+    Yield a .npy file of float32 values with the given shape,
+    written from the rows of chunks.
+    """
+    out = StringIO()
+    np.lib.format.write_array_header_1_0(out, {
+        'descr': '<f4',
+        'fortran_order': False,
+        'shape': tuple(shape),
+    })
+    yield out.getvalue()
+    for chunk in chunks:
+        yield _float32_bytes(chunk)
+
+
+def npz_bytes(meta, chunks):
+    """
+    Return a .npz file holding 'data', the float32 rows of chunks,
+    'columns', the column pcodes, and 'meta', the JSON of meta.
+    Unlike the other exports this is built in memory.
+    """
+    chunks = [np.ma.getdata(chunk).astype('<f4') for chunk in chunks]
+    return _npz_bytes(meta, chunks)
+
+
+@timed('serialize')
+def _npz_bytes(meta, chunks):
+    "Save the float32 chunks, as npz_bytes describes."
+    if chunks:
+        data = np.concatenate(chunks)
+    else:
+        data = np.zeros((0, len(meta['columns'])), dtype='<f4')
+    out = StringIO()
+    np.savez(out, data=data, columns=np.array(meta['columns']),
+             meta=np.array(json.dumps(meta)))
+    return out.getvalue()
+
+
+def iter_csv(columns, formats, chunks):
+    """
+    Yield CSV text: a row naming the columns, then the rows of chunks
+    with each column formatted with its entry in formats. Missing values
+    are left empty.
+    """
+    yield ','.join(columns) + '\n'
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        cols = [format_column(chunk[:, j], fmt, missing='')
+                for j, fmt in enumerate(formats)]
+        yield _csv_rows(cols)
+
+
+@timed('serialize')
+def _csv_rows(cols):
+    "Return CSV text joining the formatted columns cols row by row."
+    return '\n'.join(','.join(row) for row in zip(*cols)) + '\n'
@@ -1,15 +1,40 @@
 # Library code for listing-type products.
 # Functions should return dicts to be json-ized.
 
-import os
+import json
+import logging
 import datetime
+import threading
+from multiprocessing.pool import ThreadPool
+from numpy import concatenate, zeros
 from ...libwea.wea_array import WeaArray
-from ...libwea.wea_array import WeaFile
+from ...libwea.wea_file import observation_factors
+from ...libwea.resample import INTERVALS, iter_resampled
+from ...libwea.summary import choose_level, get_summary
 from ...libwea.meta import WeaMeta
+from ...libwea.station_index import get_station_index
+from ...libwea.latest import latest_tracker
+from ...libwea.stats import range_stats
+from ...libwea.metrics import timed
 from ...libwea.elements import WeaElements, DEFAULT_FORMAT
-from ...libwea.utils import filename_from_yearmonth, \
-    datetime_from_DAYTIM, get_var_units
-from ...settings import MISSINGS, DATAPATH
+from ...libwea.products.formatters import format_column, \
+    format_column_json, EXPORT_FORMATS, iter_bin, iter_npy, npz_bytes, \
+    iter_csv
+from ...libwea.utils import datetime_from_DAYTIM, get_var_units, \
+    month_range, get_conversion, convert_values, minutes_from_DAYTIM
+from ... import settings
+from ...settings import MISSINGS
+
+# Threads used to read stations in parallel for the multi-station listers.
+MULTI_WORKERS = getattr(settings, 'MULTI_WORKERS', 8)
+
+# The most stations one multi-station request may ask for.
+MULTI_MAX_STATIONS = getattr(settings, 'MULTI_MAX_STATIONS', 50)
+
+log = logging.getLogger('listers')
+
+_pool = None
+_pool_lock = threading.Lock()
 
 
 def test_list(stn, sD, eD, var_list=None):
@@ -29,20 +54,77 @@ def test_list(stn, sD, eD, var_list=None):
         'data': {},
     }
 
-    for var in var_list:
-        result['data'][var] = tuple(w.get_var(var))
+    block, var_list = w.get_vars(var_list)
+    for j, var in enumerate(var_list):
+        result['data'][var] = tuple(block[:, j].tolist())
 
     return result
 
 
-def getData(stn, sD, eD, units_system='N'):
+def _var_format(var):
+    "Return the display format of element var."
+    try:
+        return WeaElements[var]['format']
+    except KeyError:
+        return DEFAULT_FORMAT
+
+
+def select_elements(pcodes, elements=None):
     """
-    Get all elements for a stn in native time interval.
+    Return the tuple of pcodes named in elements, checked against the
+    available pcodes, or all pcodes if elements is None.
     """
+    if elements is None:
+        return tuple(pcodes)
+    elements = tuple(str(e).strip().upper() for e in elements)
+    unknown = [e for e in elements if e not in pcodes]
+    if unknown:
+        raise ValueError("Unknown elements: %s" % ",".join(unknown))
+    return elements
+
+
+def _open_data(stn, sD, eD, units_system, elements, interval=None):
+    """
+    Open the WeaArray for a data request. Return a tuple
+    (w, var_list, result) where result is from _data_result.
+    """
+    if interval is not None and interval not in INTERVALS:
+        raise ValueError("Unknown interval '%s'" % (interval,))
     w = WeaArray(stn, sD, eD, units_system=units_system)
     header = w.weafiles[-1].header
-    var_list = header['pcodes']
+    var_list = select_elements(w.get_pcodes(), elements)
+    result = _data_result(stn, sD, eD, header, var_list, units_system)
+    if interval is not None:
+        oi = INTERVALS[interval]
+        result['interval'] = interval
+        result['oi'] = oi
+        result['fac1'], result['fac2'] = \
+            observation_factors(oi) if oi else (None, None)
+    return w, var_list, result
+
+
+def _iter_blocks(w, columns, interval=None, dtype='<f4'):
+    """
+    Yield the block of columns one month at a time,
+    aggregated to interval if one is given.
+    """
+    if interval is None:
+        return w.iter_vars(columns, dtype=dtype)
+    return iter_resampled(w, columns, interval, dtype=dtype)
+
+
+def _read_block(w, columns, interval=None, dtype='<f4'):
+    "Return the whole block of columns, aggregated to interval if given."
+    if interval is None:
+        return w.get_vars(columns, dtype=dtype)[0]
+    return concatenate(list(_iter_blocks(w, columns, interval, dtype)))
 
+
+def _data_result(stn, sD, eD, header, var_list, units_system):
+    """
+    Return the getData result dict for var_list, with the
+    'data' and 'years' values still to be filled in.
+    """
     result = {
         'stn': stn,
         'oi': header['oi'],
@@ -58,18 +140,7 @@ def getData(stn, sD, eD, units_system='N'):
     }
 
     for var in var_list:
-        try:
-            fmt = WeaElements[var]['format']
-        except KeyError:
-            fmt = DEFAULT_FORMAT
-        # Populate formatted data
-        data_list = list(w.get_var(var))
-        for i in range(len(data_list)):
-            if data_list[i] in MISSINGS:
-                data_list[i] = None
-            else:
-                data_list[i] = fmt % data_list[i]
-        result['data'][var] = data_list
+        result['data'][var] = None
         # Populate units
         result['units'][var] = get_var_units(var, units_system=units_system)
         # Populate element names
@@ -78,39 +149,194 @@ def getData(stn, sD, eD, units_system='N'):
         except KeyError:
             pass
 
-    result['years'] = list(w.get_var("years"))
+    return result
+
+
+def getData(stn, sD, eD, units_system='N', elements=None, interval=None):
+    """
+    Get all elements, or only those listed in elements, for a stn
+    in native time interval, or aggregated to interval if given
+    (one of resample.INTERVALS).
+    """
+    w, var_list, result = _open_data(stn, sD, eD, units_system, elements,
+                                     interval)
+
+    # Read every element, plus the years, in a single pass. Converting
+    # in double precision keeps the formatted values unchanged.
+    block = _read_block(w, tuple(var_list) + ('YEARS',), interval, 'f8')
+    for j, var in enumerate(var_list):
+        # Populate formatted data
+        result['data'][var] = format_column(block[:, j], _var_format(var))
+
+    result['years'] = block[:, -1].astype(int).tolist()
 
     return result
 
 
-def getDataSingleDay(stn, sD, units_system='N'):
+def getDataJson(stn, sD, eD, units_system='N', elements=None,
+                interval=None):
     """
-    Get all elements for a single day.
+    Return json.dumps(getData(...)), formatting each
+    column straight to JSON text.
     """
-    # First, calculate ending date
+    w, var_list, result = _open_data(stn, sD, eD, units_system, elements,
+                                     interval)
+
+    columns = tuple(var_list) + ('YEARS',)
+    block = _read_block(w, columns, interval, 'f8')
+    def column_chunks(var):
+        return [block[:, columns.index(var)]]
+    return ''.join(_iter_data_json(result, column_chunks))
+
+
+def getDataStream(stn, sD, eD, units_system='N', elements=None,
+                  interval=None):
+    """
+    Like getDataJson, but return an iterator of JSON text chunks,
+    produced one month at a time, so memory use does not grow with the
+    date range. Files are opened before returning, so missing data
+    raises IOError.
+    """
+    w, var_list, result = _open_data(stn, sD, eD, units_system, elements,
+                                     interval)
+    def column_chunks(var):
+        return (chunk[:, 0]
+                for chunk in _iter_blocks(w, (var,), interval, 'f8'))
+    return _iter_data_json(result, column_chunks)
+
+
+def _iter_json_list(chunks):
+    "Join the non-empty JSON list item chunks into a JSON list."
+    yield '['
+    sep = ''
+    for text in chunks:
+        if text:
+            yield sep + text
+            sep = ', '
+    yield ']'
+
+
+@timed('serialize')
+def _years_json(values):
+    "Return the JSON list items of the years in the float array values."
+    return ', '.join(map(str, values.astype(int).tolist()))
+
+
+def _iter_data_json(result, column_chunks):
+    """
+    Yield result as JSON, in the key order json.dumps would use.
+    The 'data' and 'years' values are formatted from the arrays
+    yielded by column_chunks(var), with 'YEARS' for the years.
+    """
+    sep = ''
+    yield '{'
+    for key in result:
+        yield '%s%s: ' % (sep, json.dumps(key))
+        sep = ', '
+        if key == 'data':
+            yield '{'
+            var_sep = ''
+            for var in result['data']:
+                yield '%s%s: ' % (var_sep, json.dumps(var))
+                var_sep = ', '
+                fmt = _var_format(var)
+                for text in _iter_json_list(
+                        format_column_json(values, fmt)
+                        for values in column_chunks(var)):
+                    yield text
+            yield '}'
+        elif key == 'years':
+            for text in _iter_json_list(
+                    _years_json(values) for values in column_chunks('YEARS')):
+                yield text
+        else:
+            yield json.dumps(result[key])
+    yield '}'
+
+
+def getDataExport(stn, sD, eD, units_system='N', format='bin',
+                  elements=None, interval=None):
+    """
+    Get all elements, or only those listed in elements, for a stn in
+    native time interval, as one of the formatters.EXPORT_FORMATS.
+    Return a tuple (meta, chunks) where meta describes the block and
+    chunks is an iterator of the encoded output.
+
+    The block has one column per element, followed by 'YEARS'. Binary
+    values keep the data files' float32 precision and missing value;
+    CSV values are formatted as getData formats them.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError("Unknown format '%s'" % (format,))
+    w, var_list, result = _open_data(stn, sD, eD, units_system, elements,
+                                     interval)
+    columns = tuple(var_list) + ('YEARS',)
+    # CSV values are converted in double precision, as getData's are,
+    # so both format the same text.
+    dtype = 'f8' if format == 'csv' else '<f4'
+    if interval is None:
+        rows = w.num_rows()
+        chunks = w.iter_vars(columns, dtype=dtype)
+    else:
+        # Aggregated blocks are small, and their length is
+        # needed up front, so build them in memory.
+        block = _read_block(w, columns, interval, dtype)
+        rows = len(block)
+        chunks = iter([block])
+
+    meta = dict((k, v) for k, v in result.items()
+                if k not in ('data', 'years'))
+    meta.update({
+        'columns': columns,
+        'shape': (rows, len(columns)),
+        'dtype': '<f4',
+        'missing': MISSINGS[0],
+    })
+
+    if format == 'bin':
+        return meta, iter_bin(meta, chunks)
+    if format == 'npy':
+        return meta, iter_npy(meta['shape'], chunks)
+    if format == 'npz':
+        return meta, iter([npz_bytes(meta, chunks)])
+    formats = [_var_format(var) for var in var_list] + ['%d']
+    return meta, iter_csv(columns, formats, chunks)
+
+
+def single_day(sD):
+    "Return the (sD, eD) range covering the day of sD."
     sD = sD.replace(hour=0, minute=0)
     eD = sD.replace(hour=23, minute=59)
+    return sD, eD
 
-    return getData(stn, sD, eD, units_system=units_system)
 
-
-def getMostRecentData(stn, eD=None, units_system='N'):
+def getDataSingleDay(stn, sD, units_system='N', elements=None):
     """
-    Get all elements for the most recent day of data,
-    using eD as the last year/month to search.
+    Get all elements, or only those listed in elements, for a single day.
     """
-    stn_meta = WeaMeta(stn)
-    if eD is None:
-        eD = stn_meta.get_latest_month()
+    # First, calculate ending date
+    sD, eD = single_day(sD)
 
-    # This may need another level of abstraction?
-    fn = filename_from_yearmonth((eD.year, eD.month), stn)
-    wea = WeaFile(os.path.join(DATAPATH, stn, fn))
+    return getData(stn, sD, eD, units_system=units_system,
+                   elements=elements)
+
+
+def getMostRecentData(stn, eD=None, units_system='N', elements=None):
+    """
+    Get all elements, or only those listed in elements, for the most
+    recent row of data, using eD as the last year/month to search.
+    """
+    ym = (eD.year, eD.month) if eD is not None else None
+    wea, row = latest_tracker.latest(stn, ym)
 
     header = wea.header
-    latest_data = wea.latest_data()  # TODO: Convert data to units_system
+    latest_data = wea.latest_data(row)  # TODO: Convert data to units_system
     latest_data_dt = datetime_from_DAYTIM(latest_data["DAY"],
-                        latest_data["TIM"])
+                        latest_data["TIM"], latest_data["YEAR"])
+    if elements is not None:
+        var_list = select_elements(header['pcodes'], elements)
+        latest_data = dict((k, v) for k, v in latest_data.items()
+                           if k in var_list or k == 'YEAR')
     units = {}
     for pcode in latest_data:
         units[pcode] = get_var_units(pcode)
@@ -133,6 +359,161 @@ def getMostRecentData(stn, eD=None, units_system='N'):
     return result
 
 
+def _minute_of_year(d):
+    "Minutes from the start of the year of datetime d."
+    return (d.timetuple().tm_yday - 1) * 1440 + d.hour * 60 + d.minute
+
+
+def _summary_rows(block, pcodes, level, ym, sD, eD):
+    """
+    Return the rows of the level aggregate for the (year, month) ym
+    whose bins overlap sD through eD. Monthly rows always do.
+    """
+    step = INTERVALS[level]
+    if step is None or not len(block):
+        return block
+    start = minutes_from_DAYTIM(block[:, pcodes.index('DAY')],
+                                block[:, pcodes.index('TIM')])
+    keep = start >= 0
+    if ym == (sD.year, sD.month):
+        keep &= start + step > _minute_of_year(sD)
+    if ym == (eD.year, eD.month):
+        keep &= start <= _minute_of_year(eD)
+    return block[keep]
+
+
+def getSummary(stn, sD, eD, interval='daily', units_system='N',
+               elements=None):
+    """
+    Get elements for a stn aggregated to interval, served from the
+    summary files of that interval. Bins are whole hours, days or
+    months overlapping sD through eD.
+    """
+    level = choose_level(interval)
+    index = get_station_index(stn)
+    months = month_range(sD, eD)
+    entries = index.plan(months)  # raises IOError for missing months
+    header = entries[-1]['header']
+    pcodes = list(header['pcodes'])
+    for entry in reversed(entries[:-1]):
+        pcodes.extend(p for p in entry['header']['pcodes'] if p not in pcodes)
+    var_list = select_elements(pcodes, elements)
+    result = _data_result(stn, sD, eD, header, var_list, units_system)
+    oi = INTERVALS[interval]
+    result['interval'] = interval
+    result['level'] = level
+    result['oi'] = oi
+    result['fac1'], result['fac2'] = \
+        observation_factors(oi) if oi else (None, None)
+
+    chunks = []
+    years = []
+    for ym, entry in zip(months, entries):
+        pcodes, block = get_summary(stn, ym, level, entry=entry)
+        pcodes = list(pcodes)
+        block = _summary_rows(block, pcodes, level, ym, sD, eD)
+        # Elements the month lacks are left missing.
+        chunk = zeros((len(block), len(var_list)), dtype='f8')
+        chunk[:] = MISSINGS[0]
+        for j, var in enumerate(var_list):
+            if var in pcodes:
+                chunk[:, j] = block[:, pcodes.index(var)]
+        chunks.append(chunk)
+        years.extend([ym[0]] * len(block))
+    block = concatenate(chunks)
+
+    for j, var in enumerate(var_list):
+        conv_f = get_conversion(var, units_system)
+        if conv_f is not None:
+            convert_values(block[:, j], conv_f)
+        result['data'][var] = format_column(block[:, j], _var_format(var))
+    result['years'] = years
+
+    return result
+
+
+def getStats(stn, sD, eD, units_system='N', elements=None):
+    """
+    Get the min, max, mean, total and count of valid values of all
+    elements but DAY and TIM, or of those listed in elements, for a stn
+    from sD to eD. Values are formatted like getData's. Min, max and
+    mean are None if there are no valid values, and the total is then
+    zero. Rows are not regridded to a common oi, so each row of a
+    coarser month counts once, as range_stats describes.
+    """
+    w = WeaArray(stn, sD, eD, units_system=units_system)
+    header = w.weafiles[-1].header
+    pcodes = [p for p in w.get_pcodes() if p not in ('DAY', 'TIM')]
+    var_list = select_elements(pcodes, elements)
+    result = _data_result(stn, sD, eD, header, var_list, units_system)
+    del result['years']
+
+    for var in var_list:
+        stats = range_stats(w, var)
+        fmt = _var_format(var)
+        for key in ('min', 'max', 'mean', 'total'):
+            if stats[key] is not None:
+                stats[key] = fmt % stats[key]
+        result['data'][var] = stats
+
+    return result
+
+
+def _multi_pool():
+    "Return the thread pool shared by the multi-station listers."
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(MULTI_WORKERS)
+        return _pool
+
+
+def _run_multi(stns, func):
+    """
+    Call func(stn), which returns JSON text, for each of stns on the
+    thread pool. Return the results as the text of a JSON object keyed
+    by stn, where a station that failed maps to {"error": ...}.
+    Raises ValueError for more than MULTI_MAX_STATIONS stations.
+    """
+    def call(stn):
+        try:
+            return func(stn)
+        except IOError:
+            return json.dumps({"error": "No data available."})
+        except ValueError, e:
+            return json.dumps({"error": str(e)})
+        except Exception:
+            log.exception("Reading %s failed" % (stn,))
+            return json.dumps({"error": "Internal error."})
+
+    stns = [stn for i, stn in enumerate(stns) if stn not in stns[:i]]
+    if len(stns) > MULTI_MAX_STATIONS:
+        raise ValueError("At most %d stations may be requested."
+                         % MULTI_MAX_STATIONS)
+    results = _multi_pool().map(call, stns)
+    return '{%s}' % ', '.join('%s: %s' % (json.dumps(stn), result)
+                              for stn, result in zip(stns, results))
+
+
+def getDataMulti(stns, sD, eD, units_system='N', elements=None,
+                 interval=None):
+    """
+    Return the getDataJson text for each of stns, read in parallel,
+    as one JSON object keyed by stn.
+    """
+    return _run_multi(stns, lambda stn: getDataJson(stn, sD, eD,
+        units_system=units_system, elements=elements, interval=interval))
+
+
+def getMostRecentDataMulti(stns, eD=None, units_system='N', elements=None):
+    """
+    Return getMostRecentData for each of stns, read in parallel,
+    as the text of one JSON object keyed by stn.
+    """
+    return _run_multi(stns, lambda stn: json.dumps(getMostRecentData(stn,
+        eD, units_system=units_system, elements=elements)))
+
+
 def getStnDates(stn):
     """
     Get all elements for the most recent day of data,
@@ -0,0 +1,180 @@
+#
+# resample
+# Aggregate WeaArray output to coarser time steps.
+#
+
+import numpy as np
+from utils import missing_mask
+from ..settings import MISSINGS
+
+# Supported intervals, with their length in minutes.
+# Monthly steps vary in length, so have none.
+INTERVALS = {
+    'hourly': 60,
+    'daily': 1440,
+    'monthly': None,
+}
+
+# How each element is aggregated, by pcode. Elements not listed here
+# use PREFIX_RULES, then 'mean'.
+RULES = {
+    'DAY': 'first',
+    'TIM': 'first',
+    'YEARS': 'first',
+    'SID': 'first',
+    'PRE': 'sum',
+    'PTL': 'last',  # an accumulating total
+    'XBT': 'max',
+    'NBT': 'min',
+    'MWD': 'vector_mean',
+}
+PREFIX_RULES = (
+    ('MX', 'max'),
+    ('MN', 'min'),
+)
+
+
+def rule_for(pcode):
+    "Return the name of the aggregation rule for pcode."
+    pcode = str(pcode).upper()
+    if pcode in RULES:
+        return RULES[pcode]
+    for prefix, rule in PREFIX_RULES:
+        if pcode.startswith(prefix):
+            return rule
+    return 'mean'
+
+
+def bin_starts(day, tim, interval):
+    """
+    Return the indexes of the first row of each bin of interval,
+    given the DAY and TIM columns of rows in time order.
+    """
+    if interval not in INTERVALS:
+        raise ValueError("Unknown interval '%s'" % (interval,))
+    day = np.asarray(day).astype(int)
+    tim = np.asarray(tim).astype(int)
+    if not len(day):
+        return np.zeros(0, dtype=int)
+    if interval == 'hourly':
+        keys = day * 24 + tim // 100
+    elif interval == 'daily':
+        keys = day
+    else:
+        # Blocks never span more than one month.
+        keys = np.zeros(len(day), dtype=int)
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def aggregate(values, starts, rule):
+    """
+    Aggregate the 1-D array values over the bins beginning at starts,
+    ignoring missing values. Bins with no valid values are missing.
+    """
+    valid = ~missing_mask(values)
+    values = np.asarray(values, dtype='f8')
+    counts = np.add.reduceat(valid.astype(int), starts)
+    if rule == 'first':
+        return values[starts]
+    if rule == 'last':
+        # index of the last valid value in each bin
+        indexes = np.where(valid, np.arange(len(values)), -1)
+        last = np.maximum.reduceat(indexes, starts)
+        out = values[last]
+    elif rule in ('mean', 'sum'):
+        out = np.add.reduceat(np.where(valid, values, 0.0), starts)
+        if rule == 'mean':
+            out = out / np.maximum(counts, 1)
+    elif rule == 'max':
+        out = np.maximum.reduceat(np.where(valid, values, -np.inf), starts)
+    elif rule == 'min':
+        out = np.minimum.reduceat(np.where(valid, values, np.inf), starts)
+    elif rule == 'vector_mean':
+        # mean of unit vectors, for directions in degrees
+        radians = np.radians(np.where(valid, values, 0.0))
+        s = np.add.reduceat(np.where(valid, np.sin(radians), 0.0), starts)
+        c = np.add.reduceat(np.where(valid, np.cos(radians), 0.0), starts)
+        out = np.degrees(np.arctan2(s, c)) % 360
+    else:
+        raise ValueError("Unknown rule '%s'" % (rule,))
+    out[counts == 0] = MISSINGS[0]
+    return out
+
+
+def resample(block, pcodes, interval):
+    """
+    Return block, a 2-D array with columns pcodes covering at most one
+    month, aggregated to interval. pcodes must include DAY and TIM.
+    The TIM of each output row is the start of its bin.
+    """
+    pcodes = [str(p).upper() for p in pcodes]
+    data = np.ma.getdata(block)
+    day = data[:, pcodes.index('DAY')]
+    tim = data[:, pcodes.index('TIM')]
+    starts = bin_starts(day, tim, interval)
+    out = np.zeros((len(starts), len(pcodes)), dtype=block.dtype)
+    if not len(starts):
+        return out
+    for j, pcode in enumerate(pcodes):
+        out[:, j] = aggregate(block[:, j], starts, rule_for(pcode))
+    if interval == 'hourly':
+        out[:, pcodes.index('TIM')] = (tim[starts].astype(int) // 100) * 100
+    else:
+        out[:, pcodes.index('TIM')] = 0
+    return out
+
+
+def regrid(block, pcodes, times, oi, start=None, end=None):
+    """
+    Return (block, times) with block, whose rows are at times in
+    minutes since the epoch, moved onto a grid of step oi minutes.
+
+    Each output row covers [t, t + oi) for grid time t, aggregating the
+    rows in it by rule_for(pcode), so a finer block is downsampled. A
+    coarser block is spread out, leaving missing the rows no input
+    falls in. DAY, TIM and YEARS are set from the grid times.
+
+    The grid runs from the step of the first row to that of the last,
+    or from start and to end, in minutes, if they are given.
+    """
+    pcodes = [str(p).upper() for p in pcodes]
+    times = np.asarray(times, dtype='i8')
+    if not len(times):
+        return np.zeros((0, len(pcodes)), dtype=block.dtype), times
+    keys = times // oi
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    first = keys[0] if start is None else -(-start // oi)
+    last = keys[-1] if end is None else end // oi
+    grid = np.arange(first, max(last + 1, first)) * oi
+    rows = keys[starts] - first
+    keep = (rows >= 0) & (rows < len(grid))
+    out = np.zeros((len(grid), len(pcodes)), dtype=block.dtype)
+    out[:] = MISSINGS[0]
+    for j, pcode in enumerate(pcodes):
+        out[rows[keep], j] = aggregate(block[:, j], starts,
+                                       rule_for(pcode))[keep]
+
+    moments = grid.astype('M8[m]')
+    year_start = moments.astype('M8[Y]')
+    minutes = (moments - year_start.astype('M8[m]')).astype(int)
+    columns = {
+        'DAY': minutes // 1440 + 1,
+        'TIM': (minutes % 1440) // 60 * 100 + minutes % 60,
+        'YEARS': year_start.astype(int) + 1970,
+    }
+    for pcode, values in columns.items():
+        if pcode in pcodes:
+            out[:, pcodes.index(pcode)] = values
+    return out, grid
+
+
+def iter_resampled(w, pcodes, interval, dtype='<f4'):
+    """
+    Like WeaArray.iter_vars, but yield each month's
+    block aggregated to interval, in the missing mode of w.
+    """
+    pcodes = tuple(str(p).upper() for p in pcodes)
+    extra = tuple(p for p in ('DAY', 'TIM') if p not in pcodes)
+    for chunk in w.iter_vars(pcodes + extra, dtype=dtype):
+        yield w.represent(
+            resample(chunk, pcodes + extra, interval)[:, :len(pcodes)])
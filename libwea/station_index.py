@@ -0,0 +1,251 @@
+#
+# station_index
+# Per-station index of month files and their headers.
+#
+
+import os
+import json
+import datetime
+import threading
+from wea_file import WeaFile
+from file_cache import file_stamp
+from archive import archive_filename, read_directory, \
+    ENABLED as ARCHIVE_ENABLED
+from utils import yearmonth_from_filename, filename_from_yearmonth, \
+    is_valid_filename
+from .. import settings
+
+# Persist each station's index as a sidecar file in its data directory.
+PERSIST = getattr(settings, 'WEA_INDEX_PERSIST', False)
+
+# Take archived closed months from the archive without checking their
+# .wea files, so late rows or edits are only seen after packing again.
+ARCHIVE_TRUST = getattr(settings, 'WEA_ARCHIVE_TRUST', False)
+
+
+class StationIndex(object):
+    """
+    Maps (year, month) to the header fields, data offset and size of
+    each of a station's .wea files.
+
+    Headers are parsed once and re-parsed only when a file's mtime or
+    size changes. The directory is listed again only when its own mtime
+    changes. When persist is True the index is saved next to the data
+    files, so a new process starts without parsing any header.
+
+    Months packed into the station's archive (see archive.py) are read
+    from there, unless their .wea file has changed since. With
+    ARCHIVE_TRUST, closed months are taken from the archive without
+    looking at their .wea files; plan(refresh=True) checks those files
+    too, and from then on reads any that changed since packing from
+    the file, until the archive itself changes.
+    """
+
+    def __init__(self, stn_id, data_dir=None, persist=PERSIST):
+        self.stn_id = str(stn_id).lower()
+        if data_dir is None:
+            data_dir = os.path.join(settings.DATAPATH, self.stn_id)
+        self.data_dir = data_dir
+        self.persist = persist
+        self.entries = {}  # (year, month) -> entry dict
+        self._months = None
+        self._dir_mtime = None
+        self._archive = (None, {})  # (stamp, (year, month) -> entry)
+        self._overridden = set()  # archived months read from .wea files
+        self._lock = threading.Lock()
+        if self.persist:
+            self._load()
+
+    def sidecar_filename(self):
+        return os.path.join(self.data_dir, ".%s.index" % self.stn_id)
+
+    def archived(self):
+        """
+        Return a dict of (year, month) to the entries of the months in
+        the station's archive, which is read again when it changes.
+        """
+        if not ARCHIVE_ENABLED:
+            return {}
+        filename = archive_filename(self.stn_id, self.data_dir)
+        try:
+            stamp = file_stamp(filename)
+        except IOError:
+            return {}
+        with self._lock:
+            if self._archive[0] == stamp:
+                return self._archive[1]
+        try:
+            directory = read_directory(filename)
+        except IOError:
+            directory = {}
+        archived = {}
+        for ym, m in directory.items():
+            archived[ym] = {
+                'filename': os.path.join(
+                    self.data_dir, filename_from_yearmonth(ym, self.stn_id)),
+                'stamp': m['stamp'],
+                'header': m['header'],
+                'offset': m['offset'],
+                'rows': m['rows'],
+                'ym': ym,
+                'archive': filename,
+                'archive_stamp': stamp,
+            }
+        with self._lock:
+            self._archive = (stamp, archived)
+            self._overridden = set()
+        return archived
+
+    def months(self):
+        """
+        Return a sorted list of (year, month) tuples that this
+        station has data files for, or archived months.
+        """
+        try:
+            dir_mtime = os.stat(self.data_dir).st_mtime
+        except OSError, e:
+            raise IOError(e.errno, e.strerror, self.data_dir)
+        with self._lock:
+            if self._months is None or dir_mtime != self._dir_mtime:
+                self._months = sorted(
+                    yearmonth_from_filename(f)
+                    for f in os.listdir(self.data_dir)
+                    if is_valid_filename(f, self.stn_id))
+                self._dir_mtime = dir_mtime
+                for ym in self.entries.keys():
+                    if ym not in self._months:
+                        del self.entries[ym]
+            months = self._months
+        archived = self.archived()
+        if archived:
+            return sorted(set(months) | set(archived))
+        return list(months)
+
+    def entry(self, ym):
+        """
+        Return the index entry for the (year, month) tuple ym, a dict
+        with the keys filename, stamp (mtime, size), header, offset and
+        rows. An archived month also has the keys ym, archive and
+        archive_stamp, and its offset is into the archive. Raises
+        IOError if the month has no data file.
+        """
+        return self.plan([ym])[0]
+
+    def plan(self, months, refresh=False):
+        """
+        Return the index entries for a list of (year, month) tuples,
+        parsing only headers that are new or changed on disk. With
+        ARCHIVE_TRUST, archived months before the current one are not
+        looked for on disk, unless refresh is True or an earlier refresh
+        found them changed.
+        """
+        entries = []
+        changed = False
+        archived = self.archived()
+        today = datetime.date.today()
+        current = (today.year, today.month)
+        for ym in months:
+            ym = (int(ym[0]), int(ym[1]))
+            packed = archived.get(ym)
+            with self._lock:
+                trusted = ym not in self._overridden
+            if packed is not None and ARCHIVE_TRUST and ym < current \
+                    and trusted and not refresh:
+                entries.append(packed)
+                continue
+            filename = os.path.join(
+                self.data_dir, filename_from_yearmonth(ym, self.stn_id))
+            try:
+                stamp = file_stamp(filename)
+            except IOError:
+                if packed is None:
+                    raise
+                stamp = None
+            if packed is not None:
+                unchanged = stamp in (None, packed['stamp'])
+                with self._lock:
+                    if unchanged:
+                        self._overridden.discard(ym)
+                    else:
+                        self._overridden.add(ym)
+                if unchanged:
+                    entries.append(packed)
+                    continue
+            with self._lock:
+                entry = self.entries.get(ym)
+            if entry is None or entry['stamp'] != stamp:
+                entry = self._make_entry(filename, stamp)
+                with self._lock:
+                    self.entries[ym] = entry
+                changed = True
+            entries.append(entry)
+
+        if changed and self.persist:
+            with self._lock:
+                self._save()
+        return entries
+
+    def header(self, ym):
+        "Return the header of the (year, month) tuple ym."
+        return self.entry(ym)['header']
+
+    def _make_entry(self, filename, stamp):
+        "Parse the header of filename into an index entry."
+        wea = WeaFile(filename, readdata=False)
+        try:
+            header = wea.read_header()
+            offset = wea.header_size()
+        finally:
+            wea.close()
+        rows = (stamp[1] - offset) / (4 * header['ne'])
+        return {
+            'filename': filename,
+            'stamp': stamp,
+            'header': header,
+            'offset': offset,
+            'rows': rows,
+        }
+
+    def _load(self):
+        "Read entries saved by _save, ignoring a missing or bad sidecar."
+        try:
+            with open(self.sidecar_filename(), 'r') as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return
+        for key, entry in saved.items():
+            y, m = map(int, key.split('-'))
+            entry['filename'] = str(entry['filename'])
+            entry['stamp'] = tuple(entry['stamp'])
+            entry['header']['pcodes'] = tuple(
+                str(p) for p in entry['header']['pcodes'])
+            entry['header'] = dict(
+                (str(k), v) for k, v in entry['header'].items())
+            self.entries[(y, m)] = entry
+
+    def _save(self):
+        "Write entries to the sidecar file. Call with the lock held."
+        saved = dict(("%04d-%02d" % ym, entry)
+                     for ym, entry in self.entries.items())
+        filename = self.sidecar_filename()
+        tmp = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(saved, f)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            pass  # the data directory may well be read-only
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_station_index(stn_id):
+    "Return the shared StationIndex for stn_id."
+    stn_id = str(stn_id).lower()
+    with _indexes_lock:
+        index = _indexes.get(stn_id)
+        if index is None:
+            index = _indexes[stn_id] = StationIndex(stn_id)
+        return index
@@ -0,0 +1,83 @@
+#
+# stats
+# Reductions of an element over a date range, without building its rows.
+#
+
+from utils import linear_conversion
+from metrics import timed
+
+# The statistics range_stats returns.
+STATS = ('min', 'max', 'mean', 'total', 'count')
+
+
+def reduce_values(values, mask):
+    """
+    Return (min, max, total, count) of the 1-D array values where mask
+    is False, or None if there are none.
+    """
+    if mask.any():
+        values = values[~mask]
+    if not len(values):
+        return None
+    return (float(values.min()), float(values.max()),
+            float(values.sum(dtype='f8')), len(values))
+
+
+def combine(parts):
+    "Return the (min, max, total, count) of the reduce_values parts."
+    parts = [p for p in parts if p is not None]
+    if not parts:
+        return None
+    return (min(p[0] for p in parts), max(p[1] for p in parts),
+            sum(p[2] for p in parts), sum(p[3] for p in parts))
+
+
+def convert_stats(stats, mult, offset):
+    """
+    Return stats, a dict of STATS, for values converted as
+    mult * x + offset. Only valid for such linear conversions.
+    """
+    low, high = stats['min'], stats['max']
+    if mult < 0:
+        low, high = high, low
+    return {
+        'min': mult * low + offset,
+        'max': mult * high + offset,
+        'mean': mult * stats['mean'] + offset,
+        'total': mult * stats['total'] + offset * stats['count'],
+        'count': stats['count'],
+    }
+
+
+@timed('stats')
+def range_stats(w, pcode):
+    """
+    Return a dict of the min, max, mean, total and count of the valid
+    values of pcode over the range of WeaArray w, in its units_system.
+    Min, max and mean are None if there are no valid values.
+
+    The rows of each data file are reduced where they are mapped, using
+    their missing mask, and the unit conversion is applied
+    to the reduced values. Files with another oi are not regridded, so
+    each of their rows counts once.
+    """
+    pcode = str(pcode).upper()
+    if pcode not in w.get_pcodes():
+        raise ValueError("'%s' not in pcodes" % (pcode,))
+    reduced = combine(reduce_values(values, mask)
+                      for values, mask in w.iter_native(pcode))
+    if reduced is None:
+        return {'min': None, 'max': None, 'mean': None, 'total': 0.0,
+                'count': 0}
+    low, high, total, count = reduced
+    stats = {
+        'min': low,
+        'max': high,
+        'mean': total / count,
+        'total': total,
+        'count': count,
+    }
+    conversion = linear_conversion(pcode, w.units_system)
+    if conversion is not None:
+        stats = convert_stats(stats, *conversion)
+    return stats
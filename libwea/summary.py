@@ -0,0 +1,197 @@
+#
+# summary
+# Precomputed hourly, daily and monthly aggregates of each month file.
+#
+# Aggregates are stored per source month under <station>/summary/<level>/,
+# or under SUMMARY_PATH/<station>/<level>/ when that is set. They use the
+# .wea header layout, with the level's step as oi (0 for monthly). Each
+# aggregate file is given the mtime of its source month, so a change to
+# the source makes it stale.
+#
+
+import os
+import sys
+import struct
+import threading
+import numpy as np
+from wea_file import HEADER_FORMAT, HEADER_FIXED_SIZE, header_size
+from file_cache import WeaFileCache, file_stamp
+from archive import open_entry
+from station_index import get_station_index
+from resample import INTERVALS, resample
+from utils import filename_from_yearmonth, days_in_month
+from .. import settings
+
+# Levels stored for each month.
+LEVELS = ('monthly', 'daily', 'hourly')
+
+# Build missing or stale aggregates when they are first needed.
+# Off by default, so a read-only service never writes to the data.
+LAZY = getattr(settings, 'SUMMARY_LAZY', False)
+
+# Where aggregates are kept, if not beside each station's data.
+SUMMARY_PATH = getattr(settings, 'SUMMARY_PATH', None)
+
+
+class SummaryFile(object):
+    """
+    A single aggregate file, mapped read-only. Like WeaFile,
+    it has header and data attributes.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = open(filename, 'rb')
+        fixed = struct.unpack(HEADER_FORMAT, self.fd.read(HEADER_FIXED_SIZE))
+        tr, pr, oi, ne, rgt, wsh = fixed[:6]
+        pc = self.fd.read(ne * 3)
+        self.header = {
+            'tr': tr,
+            'pr': pr,
+            'oi': oi,
+            'ne': ne,
+            'rgt': rgt,
+            'wsh': wsh,
+            'pcodes': tuple(pc[i:i + 3] for i in range(0, len(pc), 3)),
+        }
+        offset = header_size(ne)
+        rows = (os.fstat(self.fd.fileno()).st_size - offset) / (4 * ne)
+        if rows:
+            self.data = np.memmap(self.fd, dtype=np.dtype('<f4'), mode='r',
+                                  offset=offset, shape=(rows, ne))
+        else:
+            self.data = np.zeros((0, ne), dtype='<f4')
+
+    def close(self):
+        self.fd.close()
+
+    def __repr__(self):
+        return "<SummaryFile %s>" % self.filename
+
+
+# Aggregate files opened by this process.
+summary_cache = WeaFileCache(loader=SummaryFile)
+
+
+def choose_level(interval):
+    "Return the level that serves a request for interval."
+    if interval not in LEVELS:
+        raise ValueError("Unknown interval '%s'" % (interval,))
+    return interval
+
+
+def is_current(stamp, source_stamp):
+    """
+    Whether an aggregate with stamp was built from the source file with
+    source_stamp. os.utime can round the mtime, so allow for that.
+    """
+    return stamp is not None and abs(stamp[0] - source_stamp[0]) < 1e-3
+
+
+def summary_filename(stn_id, ym, level):
+    "Return the path of the level aggregate for the (year, month) ym."
+    stn_id = str(stn_id).lower()
+    if SUMMARY_PATH:
+        directory = os.path.join(SUMMARY_PATH, stn_id, level)
+    else:
+        directory = os.path.join(settings.DATAPATH, stn_id, 'summary', level)
+    return os.path.join(directory, filename_from_yearmonth(ym, stn_id))
+
+
+def aggregate_month(wea, level):
+    "Return the whole month of WeaFile wea aggregated to level."
+    return resample(np.asarray(wea.data), wea.header['pcodes'], level)
+
+
+def write_summary(filename, header, block, mtime):
+    """
+    Write block as an aggregate file with the source header, then
+    give it the source mtime. Returns False if it can't be written.
+    """
+    year, month = header['ym']
+    oi = INTERVALS[header['level']] or 0
+    pcodes = header['pcodes']
+    tmp = "%s.%d.%d.tmp" % (filename, os.getpid(),
+                            threading.current_thread().ident)
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack(HEADER_FORMAT, header['tr'],
+                float(days_in_month(month, year) * 24 * 60), oi,
+                len(pcodes), header['rgt'], header['wsh'], *([0] * 8)))
+            f.write(''.join(pcodes))
+            f.write(block.astype('<f4').tobytes())
+        os.utime(tmp, (mtime, mtime))
+        os.rename(tmp, filename)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
+
+
+def build_summary(stn_id, ym, level, entry=None):
+    """
+    Aggregate the (year, month) ym of stn_id to level and write it.
+    Returns (pcodes, block), whether or not the file could be written.
+    """
+    if entry is None:
+        entry = get_station_index(stn_id).entry(ym)
+    wea = open_entry(entry)
+    block = aggregate_month(wea, level)
+    header = dict(entry['header'], ym=ym, level=level)
+    write_summary(summary_filename(stn_id, ym, level), header, block,
+                  entry['stamp'][0])
+    return wea.header['pcodes'], block
+
+
+def get_summary(stn_id, ym, level, entry=None, lazy=None):
+    """
+    Return (pcodes, block) for the level aggregate of the (year, month)
+    ym, in native units. A missing or stale aggregate is built if lazy,
+    or else computed without being saved.
+    """
+    if lazy is None:
+        lazy = LAZY
+    if entry is None:
+        entry = get_station_index(stn_id).entry(ym)
+    filename = summary_filename(stn_id, ym, level)
+    try:
+        stamp = file_stamp(filename)
+    except IOError:
+        stamp = None
+    if is_current(stamp, entry['stamp']):
+        summary = summary_cache.get(filename, stamp=stamp)
+        return summary.header['pcodes'], summary.data
+    if lazy:
+        return build_summary(stn_id, ym, level, entry)
+    wea = open_entry(entry)
+    return wea.header['pcodes'], aggregate_month(wea, level)
+
+
+def build_station(stn_id, levels=LEVELS):
+    """
+    Build every missing or stale aggregate of stn_id.
+    Returns the number of files built.
+    """
+    index = get_station_index(stn_id)
+    built = 0
+    for ym in index.months():
+        entry = index.entry(ym)
+        for level in levels:
+            filename = summary_filename(stn_id, ym, level)
+            try:
+                if is_current(file_stamp(filename), entry['stamp']):
+                    continue
+            except IOError:
+                pass
+            build_summary(stn_id, ym, level, entry)
+            built += 1
+    return built
+
+
+if __name__ == '__main__':
+    # Build the aggregates of each station given on the command line.
+    for stn_id in sys.argv[1:]:
+        print stn_id, build_station(stn_id)
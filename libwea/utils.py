@@ -4,7 +4,10 @@
 
 import re
 import datetime
+import numpy as np
 from elements import Conversions, WeaElements
+from metrics import timed
+from ..settings import MISSINGS
 
 
 def round_date(d, mins, up=False):
@@ -75,6 +78,19 @@ def get_next_month(date):
         return date.replace(month=date.month + 1, day=1)
 
 
+def month_range(sD, eD):
+    """
+    Return a list of (year, month) tuples for every month
+    from sD through eD.
+    """
+    months = []
+    t = sD
+    while t.timetuple()[:2] <= eD.timetuple()[:2]:
+        months.append((t.year, t.month))
+        t = get_next_month(t)
+    return months
+
+
 def yearmonth_from_filename(filename):
     """
     Determine the year and month based on filename.
@@ -127,6 +143,25 @@ def datetime_from_DAYTIM(DAY, TIM, year=None):
     return ret
 
 
+def minutes_from_DAYTIM(DAY, TIM):
+    """
+    Return an int array of the minutes from the start of the year
+    for arrays of Julian days DAY and HHMM times TIM.
+    """
+    DAY = np.asarray(DAY).astype(int)
+    TIM = np.asarray(TIM).astype(int)
+    return (DAY - 1) * 1440 + (TIM // 100) * 60 + TIM % 100
+
+
+def datetime64_from_DAYTIM(DAY, TIM, year):
+    """
+    Return a datetime64[m] array for arrays of Julian days DAY
+    and HHMM times TIM in year.
+    """
+    start = np.datetime64('%04d-01-01' % year, 'm')
+    return start + minutes_from_DAYTIM(DAY, TIM).astype('timedelta64[m]')
+
+
 def wea_convert(unit, units_system):
     """
     This function returns a tuple (func, units) where:
@@ -141,6 +176,73 @@ def wea_convert(unit, units_system):
     return (None,None)
 
 
+def get_conversion(pcode, units_system):
+    """
+    Return the function converting pcode from its native units to
+    units_system, or None if no conversion applies.
+    """
+    # Convert units, unless N (native)
+    if units_system == 'N':
+        return None
+    # Get this element's properties
+    try:
+        elem = WeaElements[pcode]
+    except KeyError:
+        elem = {}
+
+    # Try to get a conversion function to change units
+    if 'units' in elem and elem['units']:
+        conv_f, new_units = wea_convert(elem['units'], units_system)
+        return conv_f
+    return None
+
+
+def linear_conversion(pcode, units_system):
+    """
+    Return (mult, offset) converting pcode from its native units to
+    units_system as mult * x + offset, or None if no conversion applies.
+    """
+    if units_system == 'N':
+        return None
+    units = WeaElements.get(pcode, {}).get('units')
+    if units and (units, units_system) in Conversions:
+        mult, offset, units2 = Conversions[(units, units_system)]
+        return mult, offset
+    return None
+
+
+def missing_mask(values):
+    """
+    Return a boolean array, shaped like values, that is True wherever
+    values holds one of the MISSINGS or NaN, or is masked if values
+    is a masked array.
+    """
+    if isinstance(values, np.ma.MaskedArray):
+        return np.ma.getmaskarray(values)
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        mask = np.isnan(values)
+    else:
+        mask = np.zeros(values.shape, dtype=bool)
+    for m in MISSINGS:
+        mask |= (values == m)
+    return mask
+
+
+@timed('convert')
+def convert_values(values, conv_f, mask=None):
+    """
+    Apply the conversion function conv_f (as returned by wea_convert)
+    in place to every non-missing value of the numpy array values.
+    A missing_mask of values already at hand can be passed as mask.
+    """
+    if mask is None:
+        mask = missing_mask(values)
+    valid = ~mask
+    values[valid] = conv_f(values[valid])
+    return values
+
+
 def get_var_units(pcode, units_system='N'):
     """
     Return the units for the given pcode.
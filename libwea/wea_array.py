@@ -3,27 +3,77 @@ import sys
 import datetime
 import logging
 
-from numpy import array, nan, zeros
+import numpy as np
+from numpy import array, asarray, concatenate, datetime64, nan, zeros
 from wea_file import WeaFile
-from elements import WeaElements
-from utils import minutes_diff, round_date, get_next_month, \
-    get_var_units, wea_convert
+from archive import open_entry
+from station_index import get_station_index
+from resample import regrid
+from metrics import timed
+from utils import round_date, month_range, minutes_from_DAYTIM, \
+    filename_from_yearmonth, get_conversion, convert_values, missing_mask
 
 from ..settings import DATAPATH, MISSINGS
 
 log = logging.getLogger('WeaArray')
 
+# How missing values are returned: as one of the MISSINGS (None),
+# as NaN, or masked in a numpy masked array.
+MISSING_MODES = (None, 'nan', 'masked')
+
+
+def _minutes(d):
+    "Minutes since the epoch of datetime d, as in WeaFile.time_index."
+    return datetime64(d, 'm').astype('i8')
+
+
+@timed('slice')
+def _join_rows(chunks, dtype=None):
+    """
+    Return the row slices chunks as one array of dtype, a view when
+    there is one chunk already of dtype.
+    """
+    if len(chunks) == 1:
+        ret = asarray(chunks[0])  # a view, not a copy
+    else:
+        ret = concatenate(chunks)
+    if dtype is not None and ret.dtype != dtype:
+        ret = ret.astype(dtype)
+    return ret
+
+
+@timed('slice')
+def _copy_rows(f, rows, src, dst, years_cols, absent, width, dtype):
+    """
+    Return rows of WeaFile f as a new block width columns wide: its
+    columns src at dst, the year at years_cols and MISSINGS[0] at absent.
+    """
+    data = f.data[rows]
+    chunk = zeros((data.shape[0], width), dtype=dtype)
+    chunk[:, dst] = data[:, src]
+    chunk[:, years_cols] = f.yearmonth()[0]
+    chunk[:, absent] = MISSINGS[0]
+    return chunk
+
 
 class WeaArray(object):
     """
     Class that arranges multiple WeaFile objects into a single array.
+
+    missing is one of MISSING_MODES. With 'nan' or 'masked', missing
+    values are found from each file's cached missing_mask, and data is
+    returned as float arrays holding NaN or as masked arrays, whose
+    masked values hold MISSINGS[0].
     """
-    def __init__(self, stn_id, sD, eD, units_system='N'):
+    def __init__(self, stn_id, sD, eD, units_system='N', missing=None):
+        if missing not in MISSING_MODES:
+            raise ValueError("Unknown missing mode '%s'" % (missing,))
         self.data = None
         self.stn_id = str(stn_id).lower()
         self.sD = sD
         self.eD = eD
         self.units_system = units_system
+        self.missing = missing
         self._make_filenames()
         self._load_full_months()
 
@@ -33,28 +83,51 @@ class WeaArray(object):
     def _make_filenames(self):
         "Generate the needed data file names based on months requested."
         base = DATAPATH
-        filenames = []
-        t = self.sD
-        while t.timetuple()[:2] <= self.eD.timetuple()[:2]:
-            filenames.append(os.path.join(
-                base,
-                self.stn_id,
-                "%s%s.wea" % (self.stn_id, t.strftime("%m%y"))
-            ))
-            t = get_next_month(t)
-        self.filenames = filenames
+        self.months = month_range(self.sD, self.eD)
+        self.filenames = [
+            os.path.join(base, self.stn_id,
+                         filename_from_yearmonth(ym, self.stn_id))
+            for ym in self.months]
 
     def _load_full_months(self):
-        "Create WeaFile objects, which load the entire data file."
+        "Get WeaFile objects, which map the entire data file, from the cache."
+        # The station index supplies headers, so none are parsed here.
+        entries = get_station_index(self.stn_id).plan(self.months)
         weafiles = []
-        for f in self.filenames:
-            weafiles.append(WeaFile(f))
+        for entry in entries:
+            weafiles.append(open_entry(entry))
         self.weafiles = weafiles
         log.debug("weafiles: %s" % " ".join(map(str, weafiles)))
 
     def _last_header(self):
         return self.weafiles[-1].header
 
+    def get_oi(self):
+        """
+        The observation interval of the output grid: that of the last
+        data file, which files with another oi are regridded to.
+        """
+        return self._last_header()['oi']
+
+    def get_pcodes(self):
+        """
+        Return the pcodes found in any of the data files, those of the
+        last file first. Months without an element return it missing.
+        """
+        pcodes = list(self._last_header()['pcodes'])
+        for f in reversed(self.weafiles[:-1]):
+            pcodes.extend(p for p in f.header['pcodes'] if p not in pcodes)
+        return tuple(pcodes)
+
+    def is_mixed(self):
+        "Whether the data files differ in oi or pcodes."
+        h = self._last_header()
+        for f in self.weafiles:
+            if (f.header['oi'] != h['oi'] or
+                    tuple(f.header['pcodes']) != tuple(h['pcodes'])):
+                return True
+        return False
+
     def get_ne(self):
         return self._last_header()['ne']
         """
@@ -64,78 +137,244 @@ class WeaArray(object):
         return max(list(s))
         """
 
-    def get_var(self, pcode, round_start_up=False, round_end_up=False):
-        pcode = str(pcode).upper()
-        h = self.weafiles[0].header
-        for f in self.weafiles:
-            assert f.header['oi'] == h['oi']
-
-        rsD = round_date(self.sD, h['oi'], up=round_start_up)
-        reD = round_date(self.eD, h['oi'], up=round_end_up)
-        md = minutes_diff(rsD, reD)
-        num_vals = (md / h['oi']) + 1
-
-        # calculate starting index
-        s_indx = minutes_diff(
-            self.sD.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
-            rsD) / h['oi']
-        # calculate ending index
-        e_indx = minutes_diff(
-            self.eD.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
-            reD) / h['oi']
-
-        log.debug(h)
-        log.debug("Start (round): %s   %s" % (self.sD, rsD))
-        log.debug("End   (round): %s   %s" % (self.eD, reD))
-        log.debug("minute diff: %s" % md)
-        log.debug("num vals: %s" % num_vals)
-
-        # TODO: Use faster array operations instead of
-        # extending a list
-        ret = []
+    def _bounds(self, round_start_up=False, round_end_up=False):
+        """
+        Return the requested range rounded to get_oi(), as minutes
+        since the epoch.
+        """
+        oi = self.get_oi()
+        return (_minutes(round_date(self.sD, oi, up=round_start_up)),
+                _minutes(round_date(self.eD, oi, up=round_end_up)))
+
+    def _file_slices(self, round_start_up=False, round_end_up=False):
+        """
+        Return a list of (WeaFile, slice) pairs, one per data file,
+        giving the rows of each file that fall in the requested range.
+
+        Rows are found by binary search of each file's time index, so
+        files with gaps, missing trailing rows or a different oi are
+        sliced by the times they actually hold. The range is rounded to
+        get_oi(). A file with a coarser oi also gives the row whose step
+        covers the start, and a finer one the rows within the last step.
+        """
+        oi = self.get_oi()
+        rsD, reD = self._bounds(round_start_up, round_end_up)
+        slices = []
         for f in self.weafiles:
+            file_oi = f.header['oi']
+            index = f.time_index()
+            start = index.searchsorted(
+                rsD - file_oi + 1 if file_oi > oi else rsD, 'left')
+            end = index.searchsorted(
+                reD + oi - 1 if file_oi < oi else reD, 'right')
+            log.debug("%s: rows %s to %s (%s to %s)" % (f, start, end,
+                                                        rsD, reD))
+            slices.append((f, slice(start, end)))
+        return slices
+
+    def num_rows(self, round_start_up=False, round_end_up=False):
+        "Return the number of rows get_var would return."
+        if self.is_mixed():
+            return sum(len(chunk) for chunk in self.iter_vars(
+                ('DAY',), round_start_up, round_end_up))
+        n = 0
+        for f, rows in self._file_slices(round_start_up, round_end_up):
+            n += len(xrange(*rows.indices(f.data.shape[0])))
+        return n
+
+    def get_var(self, pcode, round_start_up=False, round_end_up=False,
+                dtype=None):
+        """
+        Return a numpy array of pcode over the requested date range.
+
+        The result keeps the native '<f4' dtype of the data files unless
+        dtype is given. When the range lies in a single file and no unit
+        conversion is needed, the result is a read-only view of the memmap.
+        """
+        pcode = str(pcode).upper()
+        if self.is_mixed():
+            chunks = list(self.iter_vars((pcode,), round_start_up,
+                                         round_end_up, dtype=dtype or '<f4'))
+            return self._concatenate(chunks)[:, 0]
+
+        conv_f = None
+        if pcode != 'YEARS':
+            conv_f = self._get_conversion(pcode)
+        use_mask = pcode != 'YEARS' and self.missing is not None
+
+        chunks = []
+        masks = []
+        for f, rows in self._file_slices(round_start_up, round_end_up):
             pcodes = list(f.header['pcodes'])
             if pcode == 'YEARS':
                 data = f.years
             elif pcode in pcodes:
                 indx = pcodes.index(pcode)
                 data = f.data[:, indx]
+                if use_mask:
+                    masks.append(f.missing_mask(rows, indx, cache=True))
             else:
                 # WHAT TO DO IF pcode DOESN'T EXIST??
                 raise ValueError("'%s' not in pcodes" % (pcode,))
+            chunks.append(data[rows])
+
+        ret = _join_rows(chunks, dtype)
+        if pcode == 'YEARS':
+            return ret
+
+        mask = None
+        if use_mask:
+            mask = masks[0] if len(masks) == 1 else concatenate(masks)
+        if conv_f is not None:
+            if not ret.flags.writeable:
+                ret = ret.copy()
+            convert_values(ret, conv_f, mask)
+        return self.represent(ret, mask)
+
+    def get_datetimes(self, round_start_up=False, round_end_up=False):
+        """
+        Return the time of each row get_var would return,
+        as a datetime64[m] array.
+        """
+        if self.is_mixed():
+            block = concatenate(list(self.iter_vars(
+                ('DAY', 'TIM', 'YEARS'), round_start_up, round_end_up)))
+            return (block[:, 2].astype(int) - 1970).astype('M8[Y]') + \
+                minutes_from_DAYTIM(block[:, 0], block[:, 1]).astype('m8[m]')
+        chunks = [f.get_datetimes64()[rows] for f, rows in
+                  self._file_slices(round_start_up, round_end_up)]
+        return concatenate(chunks)
+
+    def get_vars(self, pcodes, round_start_up=False, round_end_up=False,
+                 dtype='<f4'):
+        """
+        Return a tuple (block, pcodes) where block is a 2-D numpy array
+        of shape (rows, len(pcodes)) holding every requested element over
+        the date range, and pcodes is the column order of block.
+
+        The data files are walked once, regardless of the number of
+        elements. 'YEARS' may be requested like any other pcode.
+        """
+        pcodes = tuple(str(p).upper() for p in pcodes)
+        chunks = list(self.iter_vars(pcodes, round_start_up, round_end_up,
+                                     dtype=dtype))
+        if len(chunks) == 1:
+            block = chunks[0]
+        else:
+            block = self._concatenate(chunks)
+        return block, pcodes
+
+    def iter_vars(self, pcodes, round_start_up=False, round_end_up=False,
+                  dtype='<f4'):
+        """
+        Like get_vars, but yield the block one data file (month) at a
+        time, so that long ranges are never held in memory at once.
+
+        Files whose oi differs from get_oi() are regridded to it, and
+        elements a file lacks are filled with the missing value.
+        """
+        pcodes = tuple(str(p).upper() for p in pcodes)
+        all_pcodes = self.get_pcodes()
+        conversions = [None] * len(pcodes)
+        for j, pcode in enumerate(pcodes):
+            if pcode == 'YEARS':
+                continue
+            if pcode not in all_pcodes:
+                raise ValueError("'%s' not in pcodes" % (pcode,))
+            conversions[j] = self._get_conversion(pcode)
+
+        oi = self.get_oi()
+        rsD, reD = self._bounds(round_start_up, round_end_up)
+        use_mask = self.missing is not None
+        for f, rows in self._file_slices(round_start_up, round_end_up):
+            file_pcodes = list(f.header['pcodes'])
+            src, dst, years_cols, absent = [], [], [], []
+            for j, pcode in enumerate(pcodes):
+                if pcode == 'YEARS':
+                    years_cols.append(j)
+                elif pcode in file_pcodes:
+                    src.append(file_pcodes.index(pcode))
+                    dst.append(j)
+                else:
+                    absent.append(j)
+
+            regrid_file = f.header['oi'] != oi
+            chunk = _copy_rows(f, rows, src, dst, years_cols, absent,
+                               len(pcodes), 'f8' if regrid_file else dtype)
+            mask = None
+            if regrid_file:
+                # Cover the whole last step of a coarser file, and no
+                # more than the requested range.
+                times = f.time_index()[rows]
+                start = end = None
+                if len(times):
+                    start = max(rsD, times[0] - times[0] % oi)
+                    end = min(reD, times[-1] + max(f.header['oi'] - oi, 0))
+                chunk, times = regrid(chunk, pcodes, times, oi,
+                                      start=start, end=end)
+                chunk = chunk.astype(dtype)
+                if use_mask:
+                    mask = missing_mask(chunk)
+            elif use_mask:
+                mask = zeros(chunk.shape, dtype=bool)
+                mask[:, dst] = f.missing_mask(rows, src, cache=True)
+                mask[:, absent] = True
+            for j, conv_f in enumerate(conversions):
+                if conv_f is not None:
+                    convert_values(chunk[:, j], conv_f,
+                                   None if mask is None else mask[:, j])
+            yield self.represent(chunk, mask)
+
+    def iter_native(self, pcode, round_start_up=False, round_end_up=False):
+        """
+        Yield (values, mask) for pcode in each data file holding it:
+        its rows in the requested range, in native units, as a view of
+        the file, and their missing mask.
+        """
+        pcode = str(pcode).upper()
+        for f, rows in self._file_slices(round_start_up, round_end_up):
+            pcodes = list(f.header['pcodes'])
+            if pcode in pcodes:
+                j = pcodes.index(pcode)
+                yield f.data[rows, j], f.missing_mask(
+                    rows, j, cache=self.missing is not None)
+
+    def represent(self, values, mask=None):
+        """
+        Return values, an array holding MISSINGS where data is missing,
+        in the missing mode of this WeaArray. mask, the missing_mask of
+        values, is computed if not given.
+        """
+        if self.missing is None:
+            return values
+        if mask is None:
+            mask = missing_mask(values)
+        if self.missing == 'masked':
+            if not mask.flags.writeable:
+                mask = mask.copy()  # a view of a file's cached mask
+            return np.ma.MaskedArray(values, mask=mask,
+                                     fill_value=MISSINGS[0])
+        if values.dtype.kind != 'f':
+            values = values.astype('f8')
+        if mask.any():
+            if not values.flags.writeable:
+                values = values.copy()
+            values[mask] = nan
+        return values
+
+    def _concatenate(self, chunks):
+        if self.missing == 'masked':
+            block = np.ma.concatenate(chunks)
+            block.fill_value = MISSINGS[0]
+            return block
+        return concatenate(chunks)
 
-            # Continue by populating ret array with data.
-            # if only one data file, use start and end index.
-            if len(self.weafiles) == 1:
-                ret.extend(list(data[s_indx:e_indx + 1]))
-            # if first file, use start index to the end of the file
-            elif f == self.weafiles[0]:
-                ret.extend(list(data[s_indx:]))
-            # if last file, use start of file to the end index.
-            elif f == self.weafiles[-1]:
-                ret.extend(list(data[:e_indx + 1]))
-            else:  # use full month
-                # grab the column from the data array
-                ret.extend(list(data))
-
-        # Convert units, unless N (native)
-        if self.units_system != 'N':
-            # Get this element's properties
-            try:
-                elem = WeaElements[pcode]
-            except KeyError:
-                elem = {}
-
-            # Try to get a conversion function to change units
-            if 'units' in elem and elem['units']:
-                conv_f, new_units = wea_convert(elem['units'], self.units_system)
-                if not conv_f is None:
-                    for i in xrange(len(ret)):
-                        if not ret[i] in MISSINGS:
-                            ret[i] = conv_f(ret[i])
-
-        # Return a numpy array
-        return array(ret)
+    def _get_conversion(self, pcode):
+        """
+        Return the function converting pcode to self.units_system,
+        or None if no conversion applies.
+        """
+        return get_conversion(pcode, self.units_system)
 
 
 if __name__ == '__main__':
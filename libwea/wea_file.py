@@ -2,12 +2,55 @@
 # wea_file
 #
 
+import os
 import datetime
 import numpy as np
 import sys
 from numpy import array, zeros
-from utils import days_in_month, yearmonth_from_filename, hhmm_to_td
-from ..settings import MISSINGS
+from utils import days_in_month, yearmonth_from_filename, \
+    datetime64_from_DAYTIM, missing_mask
+from metrics import timed
+
+# The fixed part of a .wea header: tr, pr, oi, ne, rgt, wsh and
+# 8 unused shorts. The pcodes, 3 chars per element, follow it.
+HEADER_FORMAT = "<hf4h8h"
+HEADER_FIXED_SIZE = 30
+
+
+def observation_factors(oi):
+    """
+    Return the observation factors (fac1, fac2) for
+    observation interval oi.
+    """
+    if oi == 1440: fac1 = 1;  fac2 = 24
+    if oi == 360:  fac1 = 1;  fac2 = 6
+    if oi == 240:  fac1 = 1;  fac2 = 4
+    if oi == 60:   fac1 = 1;  fac2 = 1
+    if oi == 30:   fac1 = 2;  fac2 = 1
+    if oi == 20:   fac1 = 3;  fac2 = 1
+    if oi == 15:   fac1 = 4;  fac2 = 1
+    if oi == 10:   fac1 = 6;  fac2 = 1
+    if oi == 5:    fac1 = 12; fac2 = 1
+    if oi == 2:    fac1 = 30; fac2 = 1
+    if oi == 1:    fac1 = 60; fac2 = 1
+    return fac1, fac2
+
+
+def header_size(ne):
+    """
+    The number of bytes used by the header of a .wea file
+    with ne elements.
+    """
+    size = 0
+    size += 2  # tr
+    size += 4  # pr
+    size += 2  # oi
+    size += 2  # ne
+    size += 2  # rgt
+    size += 2  # wsh
+    size += 2 * 8  # unused
+    size += ne * 3  # pcode string
+    return size
 
 
 class WeaFile(object):
@@ -15,17 +58,28 @@ class WeaFile(object):
     This class reads a single .wea file and returns as a numpy.array.
     """
 
-    def __init__(self, filename, readdata=True):
+    def __init__(self, filename, readdata=True, header=None):
         self.filename = filename
-        self.header = {}
+        # A header already known (e.g. from the station index)
+        # saves parsing it again.
+        self.header = header or {}
         self.data = None
         self.years = array([])
+        self._time_index = None
+        self._mask = None
         if readdata:
             self.read_data()
 
     def _open(self):
         self.fd = open(self.filename, 'rb')
 
+    def close(self):
+        """
+        Close the file descriptor. Data already mapped stays readable.
+        """
+        if hasattr(self, 'fd'):
+            self.fd.close()
+
     def __repr__(self):
         return "<WeaFile %s>" % self.filename
 
@@ -47,6 +101,7 @@ class WeaFile(object):
         # unpack returns a tuple, so take first value
         return self._do_unpack('<h', 2)[0]
 
+    @timed('header')
     def read_header(self):
         """
         Read the header of a .wea file and save in self.header.
@@ -56,42 +111,31 @@ class WeaFile(object):
 
         if not hasattr(self, 'fd'):
             self._open()
-        tr = self._get_short()  # Always 1 ?
+        # Read the fixed part of the header with a single unpack.
+        # tr = short Always 1 ?
         # pr = float Total minutes in this file
         # oi = short Observation Interval (in minutes)
         # ne = short Number of Elements
         # rgt = short Rain Gauge Type
         # wsh = short Wind Speed Height
-        pr, oi, ne, rgt, wsh = self._do_unpack("f4h", 4 + 2 * 4)
+        # followed by 8 shorts (unused placeholders)
+        fixed = self._do_unpack(HEADER_FORMAT, HEADER_FIXED_SIZE)
+        tr, pr, oi, ne, rgt, wsh = fixed[:6]
 
         # BUG FIX. Recalculate pr manually
         year, month = self.yearmonth()
         pr = days_in_month(month, year) * 24 * 60
 
-        # Read 8 shorts (unused placeholders)
-        self._do_unpack("8h", 2 * 8)
-
         # Read pc based on ne
         # Read 3 1-byte chars per element
-        pc = ''.join(self._do_unpack("%dc" % ne * 3, ne * 3))
+        pc = self.fd.read(ne * 3)
         # Put pcodes in a tuple
         pcodes = []
         for i in range(0, len(pc), 3):
             pcodes.append(pc[i:i + 3])
         pcodes = tuple(pcodes)
 
-        # Set observation factors
-        if oi == 1440: fac1 = 1;  fac2 = 24
-        if oi == 360:  fac1 = 1;  fac2 = 6
-        if oi == 240:  fac1 = 1;  fac2 = 4
-        if oi == 60:   fac1 = 1;  fac2 = 1
-        if oi == 30:   fac1 = 2;  fac2 = 1
-        if oi == 20:   fac1 = 3;  fac2 = 1
-        if oi == 15:   fac1 = 4;  fac2 = 1
-        if oi == 10:   fac1 = 6;  fac2 = 1
-        if oi == 5:    fac1 = 12; fac2 = 1
-        if oi == 2:    fac1 = 30; fac2 = 1
-        if oi == 1:    fac1 = 60; fac2 = 1
+        fac1, fac2 = observation_factors(oi)
 
         self.header = {
             'tr': tr,
@@ -116,18 +160,9 @@ class WeaFile(object):
         if not self.header:
             self.read_header()
 
-        size = 0
-        size += 2  # tr
-        size += 4  # pr
-        size += 2  # oi
-        size += 2  # ne
-        size += 2  # rgt
-        size += 2  # wsh
-        size += 2 * 8  # unused
-        size += self.header['ne'] * 3  # pcode string
-
-        return size
+        return header_size(self.header['ne'])
 
+    @timed('open')
     def read_data(self):
         """
         Read the entire wea file and store in a numpy.array
@@ -135,54 +170,102 @@ class WeaFile(object):
         if self.data is None:
             h = self.read_header()
             ne, pr, oi = h['ne'], h['pr'], h['oi']
+            if not hasattr(self, 'fd'):
+                self._open()
             self.fd.seek(0)  # reset fd because memmap will do its own offset
-            # Create a memmap array-like object.
-            # TODO: possibly call ndarray.__new__ with this as buffer.
-            self.data = np.memmap(
-                self.fd,
-                dtype=np.dtype('<f4'),  # 32-bit float, little-endian
-                mode='r',  # read-only mode
-                offset=self.header_size(),  # skip these bytes of the header
-                shape=((pr / oi), ne))  # reshape to (num records, num elements)
+            # A month still being written holds fewer than pr / oi rows.
+            size = os.fstat(self.fd.fileno()).st_size
+            rows = min(pr / oi, (size - self.header_size()) / (4 * ne))
+            if rows > 0:
+                # Create a memmap array-like object.
+                # TODO: possibly call ndarray.__new__ with this as buffer.
+                self.data = np.memmap(
+                    self.fd,
+                    dtype=np.dtype('<f4'),  # 32-bit float, little-endian
+                    mode='r',  # read-only mode
+                    offset=self.header_size(),  # skip these bytes of the header
+                    shape=(rows, ne))  # reshape to (num records, num elements)
+            else:
+                self.data = zeros((0, ne), dtype='<f4')
             # Store array of years for this data file.
             year, month = self.yearmonth()
-            self.years = array([year] * (pr / oi))
+            self.years = array([year] * len(self.data))
 
         # Now self.data is an array like the output of readwea2.e
         # self.data[:, 2].min(): the min value of column 2 (same as pcodes[2])
         return self.data
 
-    def get_datetimes(self):
+    def get_datetimes64(self):
+        "Return the time of each row as a datetime64[m] array."
         if self.data is None:
             self.read_data()
-        dt = datetime.datetime
-        td = datetime.timedelta
         year, month = self.yearmonth()
-        dates = [dt(year, 1, 1) + td(days=int(x) - 1) + hhmm_to_td(int(y))
-                for x, y in zip(self.data[:, 0], self.data[:, 1])]
-        return dates
+        return datetime64_from_DAYTIM(self.data[:, 0], self.data[:, 1], year)
 
-    def latest_data(self):
+    def time_index(self):
         """
-        Return a slice of self.data with the most recent, non-missing data.
+        Return the time of each row as int64 minutes since the epoch,
+        in row order. Computed once, for binary searches by WeaArray.
         """
-        MISSING = 10000000.0  # TODO: Get this from settings?
-        a = self.data  # use a short reference to data array
+        if self._time_index is None:
+            self._time_index = self.get_datetimes64().astype('i8')
+        return self._time_index
 
-        # We want to find the last row of data where
-        # there is a non-missing value, excluding the first two columns,
-        # which are DAY and TIM.
-        ind = np.where(a[:,2:] < MISSING)  # the index where non-missing are
-        last_row = ind[0][-1]
+    def missing_mask(self, rows=slice(None), cols=slice(None), cache=False):
+        """
+        Return a boolean array that is True where data[rows, cols] holds
+        a missing value. With cache, the mask of the whole file is
+        computed once, in one pass, and kept for later calls.
+        """
+        if self.data is None:
+            self.read_data()
+        if cache and self._mask is None:
+            mask = missing_mask(self.data)
+            mask.flags.writeable = False  # shared by every reader
+            self._mask = mask
+        if self._mask is not None:
+            return self._mask[rows, cols]
+        return missing_mask(self.data[rows, cols])
+
+    def get_datetimes(self):
+        return self.get_datetimes64().astype(datetime.datetime).tolist()
+
+    def last_valid_row(self, start=0, block=4096):
+        """
+        Return the index of the last row at or after start with a
+        non-missing value, other than DAY and TIM, or None if there is
+        none. Scans backward from the end, block rows at a time.
+        """
+        if self.data is None:
+            self.read_data()
+        end = len(self.data)
+        while end > start:
+            first = max(start, end - block)
+            valid = ~self.missing_mask(slice(first, end),
+                                       slice(2, None)).all(axis=1)
+            if valid.any():
+                return first + int(np.flatnonzero(valid)[-1])
+            end = first
+        return None
+
+    def latest_data(self, row=None):
+        """
+        Return a dict of the most recent, non-missing data, or of the
+        data in row if it is given.
+        """
+        if row is None:
+            row = self.last_valid_row()
+            if row is None:
+                raise IOError("No data in %s" % self.filename)
         # TODO: Convert to requested units_system
         # Convert data to floats to allow json serialize
-        data = dict(zip(self.header['pcodes'], [float(i) for i in a[last_row]]))
+        data = dict(zip(self.header['pcodes'],
+                        [float(i) for i in self.data[row]]))
         # Add in the 'YEAR'
         data['YEAR'] = self.yearmonth()[0]
 
         return data
 
-
 if __name__ == '__main__':
     # This is just an example of how to use WeaFile.
     filename = sys.argv[1]
@@ -1,10 +1,46 @@
 import os
 import sys
+import time
 from werkzeug.wrappers import Request, Response
 from werkzeug.exceptions import HTTPException, NotFound
 
 import views
 from utils import url_map, ErrorResponse
+from compression import compress_response
+from profiling import ProfilerMiddleware, is_enabled
+from wrcc.wea_server.libwea import metrics
+
+
+requests_total = metrics.Counter('wea_requests_total',
+    'Requests served, by endpoint and status.', ('endpoint', 'status'))
+request_seconds = metrics.Histogram('wea_request_seconds',
+    'Time to serve a request, including its body, by endpoint.',
+    ('endpoint',))
+response_bytes = metrics.Counter('wea_response_bytes_total',
+    'Response body bytes sent, by endpoint.', ('endpoint',))
+
+
+def measure(endpoint, response, start):
+    "Count response in the request metrics once its body is sent."
+    def done(nbytes):
+        requests_total.inc(1, endpoint, response.status_code)
+        request_seconds.observe(time.time() - start, endpoint)
+        response_bytes.inc(nbytes, endpoint)
+
+    if not response.direct_passthrough:
+        done(len(response.get_data()))
+        return response
+
+    def counted(chunks):
+        nbytes = 0
+        try:
+            for chunk in chunks:
+                nbytes += len(chunk)
+                yield chunk
+        finally:
+            done(nbytes)
+    response.response = counted(response.response)
+    return response
 
 
 class BaseApp(object):
@@ -13,8 +49,10 @@ class BaseApp(object):
         self.config = config
 
     def wsgi_app(self, environ, start_response):
+        start = time.time()
         request = Request(environ)
         adapter = url_map.bind_to_environ(request.environ)
+        endpoint = 'notfound'
         try:
             endpoint, values = adapter.match()
             handler = getattr(views, endpoint)
@@ -26,14 +64,19 @@ class BaseApp(object):
         #    response = ErrorResponse("Internal Server Error")
         #    response.status_code = 500
 
+        response = compress_response(request, response)
+        if metrics.ENABLED:
+            response = measure(endpoint, response, start)
         return response(environ, start_response)
 
     def __call__(self, environ, start_response):
         return self.wsgi_app(environ, start_response)
 
 
-def create_app():
-    app = BaseApp({})
+def create_app(config=None):
+    app = BaseApp(config or {})
+    if is_enabled(app.config):
+        app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app.config)
     return app
 
 if __name__ == '__main__':
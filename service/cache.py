@@ -0,0 +1,283 @@
+#
+# cache
+# A process-wide cache of serialized responses.
+#
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from werkzeug.wrappers import Response
+from compression import mark_encoded
+from wrcc.wea_server import settings
+from wrcc.wea_server.libwea.metrics import Callback
+
+# Bound on the bytes of response bodies held in memory.
+MAX_BYTES = getattr(settings, 'RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+# Directory keeping responses across restarts, or None for memory only.
+CACHE_DIR = getattr(settings, 'RESPONSE_CACHE_DIR', None)
+# Bound on the bytes of the files kept in CACHE_DIR.
+DISK_MAX_BYTES = getattr(settings, 'RESPONSE_CACHE_DISK_MAX_BYTES',
+                         1024 * 1024 * 1024)
+
+
+class CachedResponse(object):
+    """
+    A response body with its mimetype and extra headers, valid
+    while the files it was made from still have the given etag.
+    encoded maps content encodings to the body compressed with them.
+    """
+
+    def __init__(self, etag, body, mimetype, headers=None, encoded=None):
+        self.etag = etag
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers or {}
+        self.encoded = encoded or {}
+
+    def size(self):
+        return len(self.body) + sum(len(b) for b in self.encoded.values())
+
+    def response(self, encoding=None):
+        "Return a Response of the body, encoded with encoding if given."
+        if encoding is None:
+            response = Response(self.body, mimetype=self.mimetype)
+        else:
+            response = Response(self.encoded[encoding],
+                                mimetype=self.mimetype)
+            mark_encoded(response, encoding)
+        for name, value in self.headers.items():
+            response.headers[name] = value
+        return response
+
+
+class ResponseCache(object):
+    """
+    A thread-safe, least recently used cache of CachedResponse objects,
+    bounded by the bytes of their bodies.
+
+    An entry is returned only for the etag it was stored with, so a
+    change to any file it was made from makes it a miss. If directory
+    is given, entries are also written there and read back after a
+    restart, and the least recently used files are removed to keep
+    the directory within disk_max_bytes.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, directory=CACHE_DIR,
+                 disk_max_bytes=DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # key -> CachedResponse
+        self._files = None  # filename -> size, least recently used first
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, etag):
+        "Return the CachedResponse for key and etag, or None."
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry.etag != etag:
+                self.nbytes -= entry.size()
+                entry = None
+            if entry is not None:
+                self._entries[key] = entry  # most recently used
+                self.hits += 1
+        if entry is not None:
+            if self.directory is not None:
+                self._touch(self._filename(key), None, utime=False)
+            return entry
+        entry = self._load(key)
+        if entry is not None and entry.etag == etag:
+            self._add(key, entry)
+            with self._lock:
+                self.hits += 1
+            return entry
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, entry):
+        "Store the CachedResponse entry under key."
+        if entry.size() > self.max_bytes:
+            return
+        self._add(key, entry)
+        self._save(key, entry)
+
+    def add_encoding(self, key, entry, encoding, body):
+        """
+        Keep body, the body of entry compressed with encoding, so that
+        later hits for key are not compressed again.
+        """
+        with self._lock:
+            entry.encoded[encoding] = body
+            if self._entries.get(key) is not entry:
+                return  # since evicted
+            self.nbytes += len(body)
+        self._save(key, entry)
+
+    def _add(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.size()
+            self._entries[key] = entry
+            self.nbytes += entry.size()
+            while len(self._entries) > 1 and self.nbytes > self.max_bytes:
+                old_key, old = self._entries.popitem(last=False)
+                self.nbytes -= old.size()
+                self.evictions += 1
+
+    def _filename(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(repr(key)).hexdigest() + '.cache')
+
+    def _load(self, key):
+        "Read the entry for key from directory, or return None."
+        if self.directory is None:
+            return None
+        try:
+            with open(self._filename(key), 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (IOError, ValueError):
+            return None
+        if not isinstance(meta, dict) or meta.get('key') != repr(key):
+            return None
+        try:
+            # Files from before encoded bodies were kept have none.
+            encoded = {}
+            for encoding, length in meta.get('encoded', ()):
+                encoded[encoding] = body[-length:]
+                body = body[:-length]
+            entry = CachedResponse(meta['etag'], body, meta['mimetype'],
+                                   meta['headers'], encoded)
+        except (KeyError, TypeError, ValueError):
+            return None  # a file in another format is a miss
+        self._touch(self._filename(key), None)
+        return entry
+
+    def _save(self, key, entry):
+        "Write entry for key to directory, ignoring failures."
+        if self.directory is None:
+            return
+        filename = self._filename(key)
+        tmp = "%s.%d.%d.tmp" % (filename, os.getpid(),
+                                threading.current_thread().ident)
+        meta = {
+            'key': repr(key),
+            'etag': entry.etag,
+            'mimetype': entry.mimetype,
+            'headers': entry.headers,
+            # The encoded bodies follow the body, in reverse order.
+            'encoded': [(encoding, len(body)) for encoding, body
+                        in reversed(entry.encoded.items())],
+        }
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp, 'wb') as f:
+                f.write(json.dumps(meta) + '\n')
+                f.write(entry.body)
+                for body in entry.encoded.values():
+                    f.write(body)
+                size = f.tell()
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            return
+        self._touch(filename, size)
+        self._evict_files()
+
+    def _list_files(self):
+        "Read the files of directory, oldest first. Call with the lock held."
+        self._files = OrderedDict()
+        self.disk_bytes = 0
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        files = []
+        for name in names:
+            if not name.endswith('.cache'):
+                continue
+            name = os.path.join(self.directory, name)
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            files.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(files):
+            self._files[name] = size
+            self.disk_bytes += size
+
+    def _touch(self, filename, size, utime=True):
+        """
+        Mark filename as the most recently used file, with size bytes,
+        or its size as already known if size is None. Unless utime is
+        False, a known file's mtime is updated too.
+        """
+        with self._lock:
+            if self._files is None:
+                self._list_files()
+            old = self._files.pop(filename, None)
+            if size is None:
+                if old is None:
+                    return
+                size = old
+                if utime:
+                    try:
+                        os.utime(filename, None)  # order across restarts
+                    except OSError:
+                        pass
+            self.disk_bytes += size - (old or 0)
+            self._files[filename] = size
+
+    def _evict_files(self):
+        "Remove the least recently used files beyond disk_max_bytes."
+        with self._lock:
+            while len(self._files) > 1 and \
+                    self.disk_bytes > self.disk_max_bytes:
+                filename, size = self._files.popitem(last=False)
+                self.disk_bytes -= size
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+
+    def clear(self):
+        "Forget every entry held in memory."
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        "Return a dict of cache counters."
+        with self._lock:
+            return {
+                'responses': len(self._entries),
+                'bytes': self.nbytes,
+                'disk_bytes': self.disk_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# The cache shared by every request in this process.
+response_cache = ResponseCache()
+
+Callback('wea_response_cache_bytes', 'Bytes held by the response cache.',
+         lambda: response_cache.stats()['bytes'])
+Callback('wea_response_cache_lookups_total',
+         'Response cache lookups, by result.',
+         lambda: dict(((k,), response_cache.stats()[k])
+                      for k in ('hits', 'misses')),
+         labels=('result',), kind='counter')
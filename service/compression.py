@@ -0,0 +1,81 @@
+#
+# compression
+# gzip and deflate content encoding of responses.
+#
+
+import zlib
+from wrcc.wea_server import settings
+
+# Bodies smaller than this many bytes are sent as they are.
+MIN_SIZE = getattr(settings, 'COMPRESS_MIN_SIZE', 1024)
+# zlib compression level, 1 (fastest) to 9 (smallest).
+LEVEL = getattr(settings, 'COMPRESS_LEVEL', 6)
+
+# Supported encodings, preferred first.
+ENCODINGS = ('gzip', 'deflate')
+
+
+def choose_encoding(request):
+    "Return the encoding request accepts that we prefer, or None."
+    for encoding in ENCODINGS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def _compressor(encoding, level=LEVEL):
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level)
+
+
+def compress(data, encoding, level=LEVEL):
+    "Return data, a str, compressed with encoding."
+    c = _compressor(encoding, level)
+    return c.compress(data) + c.flush()
+
+
+def iter_compress(chunks, encoding, level=LEVEL):
+    "Yield the chunks of a streamed body compressed with encoding."
+    c = _compressor(encoding, level)
+    for chunk in chunks:
+        chunk = c.compress(chunk)
+        if chunk:
+            yield chunk
+    yield c.flush()
+
+
+def mark_encoded(response, encoding):
+    """
+    Set the headers of response for a body encoded with encoding.
+    The ETag becomes weak, as it no longer names the exact bytes.
+    """
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(request, response):
+    """
+    Compress the body of response if request accepts an encoding.
+    Streamed bodies are compressed as they are sent; others only
+    if at least MIN_SIZE bytes.
+    """
+    if (response.status_code != 200 or
+            'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+    if response.direct_passthrough:
+        response.response = iter_compress(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    mark_encoded(response, encoding)
+    return response
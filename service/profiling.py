@@ -0,0 +1,149 @@
+#
+# profiling
+# Opt-in cProfile capture of single requests.
+#
+# A request carrying profile=<PROFILE_SECRET> is profiled and answered
+# with its stats as text. With PROFILE_DIR set, a PROFILE_SAMPLE_RATE
+# fraction of all requests is also profiled, and every profile is saved
+# there as a .prof file, keeping the newest PROFILE_KEEP. Saved profiles
+# can be combined with pstats, or with:
+#
+#   python -m wrcc.wea_server.service.profiling PROFILE_DIR
+#
+
+import os
+import sys
+import time
+import random
+import pstats
+import cProfile
+import itertools
+from cStringIO import StringIO
+from werkzeug.urls import url_decode
+from werkzeug.wrappers import Response
+from wrcc.wea_server import settings
+
+# Set in the WSGI environ of a request profiled on demand.
+PROFILE_KEY = 'wea_server.profile'
+
+DEFAULTS = {
+    'PROFILE_SECRET': None,
+    'PROFILE_SAMPLE_RATE': 0.0,
+    'PROFILE_DIR': None,
+    'PROFILE_KEEP': 1000,
+    'PROFILE_LIMIT': 60,  # lines of stats returned to the client
+}
+
+
+def get_config(config):
+    """
+    Return the profiling options, taken from config, then settings,
+    then DEFAULTS.
+    """
+    return dict((k, config.get(k, getattr(settings, k, v)))
+                for k, v in DEFAULTS.items())
+
+
+def is_enabled(config):
+    "Whether config turns profiling on at all."
+    options = get_config(config)
+    return bool(options['PROFILE_SECRET'] or
+                (options['PROFILE_SAMPLE_RATE'] and options['PROFILE_DIR']))
+
+
+class ProfilerMiddleware(object):
+    """
+    Wrap a WSGI app so that chosen requests run under cProfile,
+    including the sending of a streamed body.
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        options = get_config(config)
+        self.secret = options['PROFILE_SECRET']
+        self.sample_rate = options['PROFILE_SAMPLE_RATE']
+        self.directory = options['PROFILE_DIR']
+        self.keep = options['PROFILE_KEEP']
+        self.limit = options['PROFILE_LIMIT']
+        self._count = itertools.count()
+
+    def __call__(self, environ, start_response):
+        args = url_decode(environ.get('QUERY_STRING', ''))
+        requested = (self.secret is not None and
+                     args.get('profile') == self.secret)
+        sampled = (not requested and self.directory is not None and
+                   random.random() < self.sample_rate)
+        if not (requested or sampled):
+            return self.app(environ, start_response)
+        if requested:
+            environ[PROFILE_KEY] = True  # run the view, not a cache hit
+
+        started = []
+        def capture(status, headers, exc_info=None):
+            started[:] = [status, headers, exc_info]
+            return lambda data: None
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            body = self.app(environ, capture)
+            try:
+                chunks = list(body)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+        finally:
+            profile.disable()
+
+        if self.directory is not None:
+            self.save(profile, environ.get('PATH_INFO', ''))
+        if requested:
+            return Response(self.stats_text(profile),
+                            mimetype='text/plain')(environ, start_response)
+        start_response(*started)
+        return chunks
+
+    def stats_text(self, profile):
+        "Return the stats of profile as text, by cumulative time."
+        out = StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(self.limit)
+        return out.getvalue()
+
+    def save(self, profile, path):
+        """
+        Write profile to the profile directory, then remove the oldest
+        profiles beyond the number to keep.
+        """
+        name = "%s-%s-%d-%d.prof" % (time.strftime('%Y%m%d-%H%M%S'),
+                                     path.strip('/').replace('/', '_'),
+                                     os.getpid(), next(self._count))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            profile.dump_stats(os.path.join(self.directory, name))
+            for old in saved_profiles(self.directory)[:-self.keep]:
+                os.remove(old)
+        except (IOError, OSError):
+            pass
+
+
+def saved_profiles(directory):
+    "Return the .prof files in directory, oldest first."
+    files = [os.path.join(directory, f) for f in os.listdir(directory)
+             if f.endswith('.prof')]
+    return sorted(files, key=os.path.getmtime)
+
+
+def aggregate(directory, stream=sys.stdout, sort='cumulative', limit=60):
+    "Print the combined stats of every profile saved in directory."
+    files = saved_profiles(directory)
+    if not files:
+        return None
+    stats = pstats.Stats(*files, stream=stream)
+    stats.sort_stats(sort).print_stats(limit)
+    return stats
+
+
+if __name__ == '__main__':
+    aggregate(sys.argv[1])
@@ -1,11 +1,29 @@
 import json
+import hashlib
 import datetime
+import functools
 from werkzeug.routing import Map, Rule
 from werkzeug.wrappers import Request, Response
+from wrcc.wea_server import settings
+from wrcc.wea_server.libwea.metrics import timed
+from compression import choose_encoding, compress, \
+    MIN_SIZE as COMPRESS_MIN_SIZE
+from profiling import PROFILE_KEY
 
 # The global url map for this app.
 url_map = Map([])
 
+# Bump when a change to the code changes response bodies, so that
+# ETags and cached bodies from before are not used again.
+OUTPUT_VERSION = 1
+
+# Seconds that responses covering only closed months may be cached.
+HISTORICAL_MAX_AGE = getattr(settings, 'HISTORICAL_MAX_AGE', 7 * 24 * 3600)
+
+# Seconds after a month ends before it counts as closed, since late
+# rows may still arrive.
+CLOSED_GRACE = getattr(settings, 'CLOSED_GRACE', 3 * 24 * 3600)
+
 
 def expose(rule, **kw):
     """Expose a view function at the given URL."""
@@ -26,12 +44,44 @@ def require(request, required_args):
         return "Arguments required: %s" % ",".join(failed)
 
 
+@timed('serialize')
 def JsonResponse(o):
     return Response(json.dumps(o), mimetype="application/json")
 
 
+def JsonTextResponse(s):
+    "Send s, which is already serialized JSON text."
+    return Response(s, mimetype="application/json")
+
+
+def StreamingJsonResponse(chunks):
+    """
+    Send an iterable of JSON text chunks as they are produced,
+    without buffering the whole body.
+    """
+    return Response(chunks, mimetype="application/json",
+                    direct_passthrough=True)
+
+
+def ExportResponse(meta, chunks, mimetype):
+    """
+    Stream the encoded chunks of a data export, with meta
+    sent as JSON in the X-Wea-Meta header.
+    """
+    response = Response(chunks, mimetype=mimetype, direct_passthrough=True)
+    response.headers['X-Wea-Meta'] = json.dumps(meta)
+    return response
+
+
 def ErrorResponse(s):
-    return JsonResponse({"error": s})
+    response = JsonResponse({"error": s})
+    response.is_error = True  # not to be cached, though status 200
+    return response
+
+
+def is_error(response):
+    "Whether response was made by ErrorResponse."
+    return getattr(response, 'is_error', False)
 
 
 def parse_date(date_string, sep="-"):
@@ -47,3 +97,170 @@ def parse_date(date_string, sep="-"):
     except:
         return None
     return dt
+
+
+def parse_list(list_string, sep=","):
+    """
+    Parse a list of strings from request string like "AVA,PRE".
+    Return None if list_string is None or empty.
+    """
+    if not list_string:
+        return None
+    return [s.strip() for s in list_string.split(sep) if s.strip()]
+
+
+def file_validators(entries):
+    """
+    Return (etag, last_modified) for the .wea files of station index
+    entries, from their paths, sizes and mtimes and OUTPUT_VERSION.
+    """
+    h = hashlib.md5("v%d\n" % OUTPUT_VERSION)
+    for entry in sorted(entries, key=lambda e: e['filename']):
+        mtime, size = entry['stamp']
+        h.update("%s %r %d\n" % (entry['filename'], mtime, size))
+    last_modified = datetime.datetime.utcfromtimestamp(
+        int(max(e['stamp'][0] for e in entries)))
+    return h.hexdigest(), last_modified
+
+
+def is_closed(entries):
+    """
+    Whether the files of entries are all for months that ended at
+    least CLOSED_GRACE seconds ago.
+    """
+    from wrcc.wea_server.libwea.utils import yearmonth_from_filename
+    cutoff = datetime.datetime.now() - \
+        datetime.timedelta(seconds=CLOSED_GRACE)
+    return all(yearmonth_from_filename(e['filename']) <
+               (cutoff.year, cutoff.month) for e in entries)
+
+
+def conditional(files, historical=True):
+    """
+    Decorate a view so its response carries an ETag and Last-Modified
+    for the .wea files it reads, given as station index entries by
+    files(request). A request whose If-None-Match or If-Modified-Since
+    still holds is answered 304 without calling the view.
+
+    If historical, ranges of closed months may be cached for
+    HISTORICAL_MAX_AGE seconds; other responses, and every response of
+    a view that reports the latest data, must be revalidated. Errors
+    are sent without validators, so they are not cached.
+    """
+    def decorate(f):
+        @functools.wraps(f)
+        def view(request, **kw):
+            try:
+                entries = files(request)
+            except IOError:
+                entries = None
+            if not entries:
+                return f(request, **kw)
+
+            etag, last_modified = file_validators(entries)
+            request.file_etag = etag  # for cached views
+            if request.if_none_match:
+                modified = not request.if_none_match.contains_weak(etag)
+            elif request.if_modified_since:
+                modified = last_modified > request.if_modified_since
+            else:
+                modified = True
+            response = f(request, **kw) if modified else Response(status=304)
+            if is_error(response):
+                return response
+
+            # An encoded body is not the exact bytes etag names. A 304
+            # gets the same weak ETag the encoded 200 would have had.
+            encoded = ('Content-Encoding' in response.headers or
+                       choose_encoding(request) is not None)
+            response.set_etag(etag, weak=encoded)
+            response.vary.add('Accept-Encoding')
+            response.last_modified = last_modified
+            if historical and is_closed(entries):
+                response.cache_control.public = True
+                response.cache_control.max_age = HISTORICAL_MAX_AGE
+            else:
+                response.cache_control.no_cache = True
+            return response
+        return view
+    return decorate
+
+
+def query_key(request):
+    """
+    Return a normalized key for the query of request, so that
+    equivalent spellings of a query share a cache entry. The key
+    includes OUTPUT_VERSION.
+    """
+    args = []
+    for name in sorted(request.args):
+        value = request.args.get(name)
+        if name in ('stream', 'profile'):
+            continue  # the same body either way
+        if name in ('sD', 'eD'):
+            value = parse_date(value)
+            value = value and value.timetuple()[:5]
+        elif name == 'stn':
+            value = value.lower()
+        elif name == 'elements':
+            value = tuple(e.upper() for e in parse_list(value) or [])
+        args.append((name, value))
+    return (OUTPUT_VERSION, request.path, tuple(args))
+
+
+def cached(f):
+    """
+    Decorate a view, below conditional, to keep its response bodies in
+    the response cache for as long as the files they came from are
+    unchanged. Streamed bodies are kept once fully sent. Requests
+    profiled on demand bypass the cache.
+    """
+    @functools.wraps(f)
+    def view(request, **kw):
+        from cache import response_cache, CachedResponse
+        etag = getattr(request, 'file_etag', None)
+        if etag is None or request.environ.get(PROFILE_KEY):
+            return f(request, **kw)
+        key = query_key(request)
+
+        def respond(entry):
+            "Send entry, compressed at most once per encoding."
+            encoding = choose_encoding(request)
+            if encoding is None or len(entry.body) < COMPRESS_MIN_SIZE:
+                return entry.response()
+            if encoding not in entry.encoded:
+                response_cache.add_encoding(key, entry, encoding,
+                                            compress(entry.body, encoding))
+            return entry.response(encoding)
+
+        entry = response_cache.get(key, etag)
+        if entry is not None:
+            return respond(entry)
+
+        response = f(request, **kw)
+        if response.status_code != 200 or is_error(response):
+            return response
+        headers = {}
+        if 'X-Wea-Meta' in response.headers:
+            headers['X-Wea-Meta'] = response.headers['X-Wea-Meta']
+        def store(body):
+            entry = CachedResponse(etag, body, response.mimetype, headers)
+            response_cache.put(key, entry)
+            return entry
+
+        if not response.direct_passthrough:
+            return respond(store(response.get_data()))
+
+        def tee(chunks):
+            parts = []
+            size = 0
+            for chunk in chunks:
+                yield chunk
+                size += len(chunk)
+                if size <= response_cache.max_bytes:
+                    parts.append(chunk)
+            if size <= response_cache.max_bytes:
+                store(''.join(parts))
+        response.response = tee(response.response)
+        return response
+    return view
@@ -2,9 +2,62 @@
 # backend library code.
 
 import datetime
-from utils import url_map, expose, require, \
-            JsonResponse, ErrorResponse, \
-            parse_date
+from werkzeug.wrappers import Response
+from utils import url_map, expose, require, conditional, cached, \
+            JsonResponse, JsonTextResponse, StreamingJsonResponse, \
+            ExportResponse, ErrorResponse, parse_date, parse_list
+
+
+def _stations(request):
+    """
+    The stations named by the stn of request, or none if there are
+    more than a multi-station request may ask for.
+    """
+    from wrcc.wea_server.libwea.products.listers import MULTI_MAX_STATIONS
+    stns = parse_list(request.args.get('stn')) or []
+    return stns if len(set(stns)) <= MULTI_MAX_STATIONS else []
+
+
+def _files(stns, sD, eD):
+    "Index entries of the files read for stns from sD to eD."
+    from wrcc.wea_server.libwea.station_index import get_station_index
+    from wrcc.wea_server.libwea.utils import month_range
+    if sD is None or eD is None:
+        return []
+    entries = []
+    for stn in stns:
+        entries.extend(get_station_index(stn).plan(month_range(sD, eD)))
+    return entries
+
+
+def range_files(request):
+    "Index entries of the files read for the stn, sD and eD of request."
+    return _files(_stations(request),
+                  parse_date(request.args.get('sD')),
+                  parse_date(request.args.get('eD')))
+
+
+def day_files(request):
+    "Index entries of the files read for the stn and sD of request."
+    from wrcc.wea_server.libwea.products.listers import single_day
+    sD = parse_date(request.args.get('sD'))
+    if sD is None:
+        return []
+    return _files(_stations(request), *single_day(sD))
+
+
+def recent_files(request):
+    """
+    Index entries of the files getMostRecentData reads for the stn
+    of request: those the latest row tracker searched up to eD.
+    """
+    from wrcc.wea_server.libwea.latest import latest_tracker
+    eD = parse_date(request.args.get('eD', None))
+    ym = (eD.year, eD.month) if eD is not None else None
+    entries = []
+    for stn in _stations(request):
+        entries.extend(latest_tracker.entries(stn, ym))
+    return entries
 
 
 @expose('/')
@@ -15,6 +68,13 @@ def list_routes(request):
     })
 
 
+@expose('/metrics')
+def metrics(request):
+    "Counters and timings, in the Prometheus text format."
+    from wrcc.wea_server.libwea.metrics import render
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
 @expose('/test')
 def test_list(request):
     "An example view"
@@ -33,8 +93,12 @@ def test_list(request):
 
 
 @expose('/getData')
+@conditional(range_files)
+@cached
 def getData(request):
-    from wrcc.wea_server.libwea.products.listers import getData
+    from wrcc.wea_server.libwea.products.listers import getDataJson, \
+        getDataStream, getDataExport
+    from wrcc.wea_server.libwea.products.formatters import EXPORT_FORMATS
     error = require(request, ['stn', 'sD', 'eD'])
     if error:
         return ErrorResponse(error)
@@ -43,18 +107,40 @@ def getData(request):
     sD = parse_date(request.args.get('sD'))
     eD = parse_date(request.args.get('eD'))
     units_system = request.args.get('units', 'N')  # N (native) units by default
+    stream = request.args.get('stream', '0') == '1'  # stream month by month
+    format = request.args.get('format', 'json')
+    if format != 'json' and format not in EXPORT_FORMATS:
+        return ErrorResponse("Unknown format '%s'." % format)
+    elements = parse_list(request.args.get('elements'))  # all by default
+    interval = request.args.get('interval', None)  # native interval by default
 
     try:
-        result = getData(stn, sD, eD, units_system=units_system)
+        if format != 'json':
+            meta, chunks = getDataExport(stn, sD, eD,
+                units_system=units_system, format=format, elements=elements,
+                interval=interval)
+            return ExportResponse(meta, chunks, EXPORT_FORMATS[format])
+        if stream:
+            return StreamingJsonResponse(getDataStream(stn, sD, eD,
+                units_system=units_system, elements=elements,
+                interval=interval))
+        result = getDataJson(stn, sD, eD, units_system=units_system,
+                             elements=elements, interval=interval)
     except IOError:
         return ErrorResponse("No data available.")
+    except ValueError, e:
+        return ErrorResponse(str(e))
 
-    return JsonResponse(result)
+    return JsonTextResponse(result)
 
 
 @expose('/getDataSingleDay')
+@conditional(day_files)
+@cached
 def getDataSingleDay(request):
-    from wrcc.wea_server.libwea.products.listers import getDataSingleDay
+    from wrcc.wea_server.libwea.products.listers import getDataSingleDay, \
+        getDataExport, single_day
+    from wrcc.wea_server.libwea.products.formatters import EXPORT_FORMATS
     error = require(request, ['stn', 'sD'])
     if error:
         return ErrorResponse(error)
@@ -62,16 +148,30 @@ def getDataSingleDay(request):
     stn = request.args.get('stn')
     sD = parse_date(request.args.get('sD'))
     units_system = request.args.get('units', 'N')  # N (native) units by default
+    format = request.args.get('format', 'json')
+    if format != 'json' and format not in EXPORT_FORMATS:
+        return ErrorResponse("Unknown format '%s'." % format)
+    elements = parse_list(request.args.get('elements'))  # all by default
 
     try:
-        result = getDataSingleDay(stn, sD, units_system=units_system)
+        if format != 'json':
+            sD, eD = single_day(sD)
+            meta, chunks = getDataExport(stn, sD, eD,
+                units_system=units_system, format=format, elements=elements)
+            return ExportResponse(meta, chunks, EXPORT_FORMATS[format])
+        result = getDataSingleDay(stn, sD, units_system=units_system,
+                                  elements=elements)
     except IOError:
         return ErrorResponse("No data available.")
+    except ValueError, e:
+        return ErrorResponse(str(e))
 
     return JsonResponse(result)
 
 
 @expose('/getMostRecentData')
+@conditional(recent_files, historical=False)
+@cached
 def getMostRecentData(request):
     from wrcc.wea_server.libwea.products.listers import getMostRecentData
     error = require(request, ['stn'])
@@ -81,11 +181,132 @@ def getMostRecentData(request):
     stn = request.args.get('stn')
     eD = parse_date(request.args.get('eD', None))
     units_system = request.args.get('units', 'N')  # N (native) units by default
+    elements = parse_list(request.args.get('elements'))  # all by default
+
+    try:
+        result = getMostRecentData(stn, eD, units_system=units_system,
+                                   elements=elements)
+    except IOError:
+        return ErrorResponse("No data available.")
+    except ValueError, e:
+        return ErrorResponse(str(e))
+
+    return JsonResponse(result)
+
+
+@expose('/getDataMulti')
+@conditional(range_files)
+@cached
+def getDataMulti(request):
+    from wrcc.wea_server.libwea.products.listers import getDataMulti
+    error = require(request, ['stn', 'sD', 'eD'])
+    if error:
+        return ErrorResponse(error)
+
+    stns = parse_list(request.args.get('stn'))
+    sD = parse_date(request.args.get('sD'))
+    eD = parse_date(request.args.get('eD'))
+    units_system = request.args.get('units', 'N')  # N (native) units by default
+    elements = parse_list(request.args.get('elements'))  # all by default
+    interval = request.args.get('interval', None)  # native interval by default
+    if not stns:
+        return ErrorResponse("Arguments required: stn")
+    if sD is None or eD is None:
+        return ErrorResponse("Dates must be given as YYYY-MM-DD-HH-MM.")
+
+    # Other errors are reported per station, in the result.
+    try:
+        result = getDataMulti(stns, sD, eD, units_system=units_system,
+                              elements=elements, interval=interval)
+    except ValueError, e:
+        return ErrorResponse(str(e))
+
+    return JsonTextResponse(result)
+
+
+@expose('/getMostRecentMulti')
+@conditional(recent_files, historical=False)
+@cached
+def getMostRecentMulti(request):
+    from wrcc.wea_server.libwea.products.listers import \
+        getMostRecentDataMulti
+    error = require(request, ['stn'])
+    if error:
+        return ErrorResponse(error)
+
+    stns = parse_list(request.args.get('stn'))
+    eD = parse_date(request.args.get('eD', None))
+    units_system = request.args.get('units', 'N')  # N (native) units by default
+    elements = parse_list(request.args.get('elements'))  # all by default
+    if not stns:
+        return ErrorResponse("Arguments required: stn")
+    if eD is None and request.args.get('eD') is not None:
+        return ErrorResponse("Dates must be given as YYYY-MM-DD-HH-MM.")
+
+    # Other errors are reported per station, in the result.
+    try:
+        result = getMostRecentDataMulti(stns, eD, units_system=units_system,
+                                        elements=elements)
+    except ValueError, e:
+        return ErrorResponse(str(e))
+
+    return JsonTextResponse(result)
+
+
+@expose('/getSummary')
+@conditional(range_files)
+@cached
+def getSummary(request):
+    from wrcc.wea_server.libwea.products.listers import getSummary
+    error = require(request, ['stn', 'sD', 'eD'])
+    if error:
+        return ErrorResponse(error)
+
+    stn = request.args.get('stn')
+    sD = parse_date(request.args.get('sD'))
+    eD = parse_date(request.args.get('eD'))
+    interval = request.args.get('interval', 'daily')
+    units_system = request.args.get('units', 'N')  # N (native) units by default
+    elements = parse_list(request.args.get('elements'))  # all by default
+
+    try:
+        result = getSummary(stn, sD, eD, interval=interval,
+                            units_system=units_system, elements=elements)
+    except IOError:
+        return ErrorResponse("No data available.")
+    except ValueError, e:
+        return ErrorResponse(str(e))
+
+    return JsonResponse(result)
+
+
+@expose('/getStats')
+@conditional(range_files)
+@cached
+def getStats(request):
+    """
+    Min, max, mean, total and count of each element over a range. Where
+    the range mixes observation intervals, each row of a coarser month
+    counts once, so these can differ from reducing /getData's rows.
+    """
+    from wrcc.wea_server.libwea.products.listers import getStats
+    error = require(request, ['stn', 'sD', 'eD'])
+    if error:
+        return ErrorResponse(error)
+
+    stn = request.args.get('stn')
+    sD = parse_date(request.args.get('sD'))
+    eD = parse_date(request.args.get('eD'))
+    units_system = request.args.get('units', 'N')  # N (native) units by default
+    elements = parse_list(request.args.get('elements'))  # all by default
 
     try:
-        result = getMostRecentData(stn, eD, units_system=units_system)
+        result = getStats(stn, sD, eD, units_system=units_system,
+                          elements=elements)
     except IOError:
         return ErrorResponse("No data available.")
+    except ValueError, e:
+        return ErrorResponse(str(e))
 
     return JsonResponse(result)
 
@@ -1,18 +1,36 @@
+import os
+import sys
+import shutil
+import struct
+import tempfile
 import datetime
 import unittest
 import requests
 import json
-from numpy import array
+from cStringIO import StringIO
+from numpy import array, concatenate, dtype, flatnonzero, frombuffer, \
+    isnan, ma
 from unittest import TestCase
 from libwea.utils import round_date, minutes_diff, days_in_month, is_leap, \
                     is_valid_filename, filename_from_yearmonth, \
                     datetime_from_DAYTIM, wea_convert, get_var_units, \
-                    hhmm_to_td
+                    hhmm_to_td, missing_mask
 from libwea.wea_file import WeaFile
 from libwea.wea_array import WeaArray
 from libwea.meta import WeaMeta
+from libwea.file_cache import WeaFileCache, open_weafile
+from libwea.station_index import StationIndex, get_station_index
+from libwea.resample import rule_for, aggregate, iter_resampled
+from libwea import summary, metrics, archive, stats
+from libwea.latest import LatestTracker
+from libwea.products import listers
+from bench import synth
+from libwea.products.formatters import format_column, format_column_json
 from libwea.elements import WeaElements
-from service import utils
+from libwea import elements
+from service import utils, compression, profiling, application
+from service.cache import ResponseCache, CachedResponse
+import settings
 from settings import TEST_SERVICE
 
 class DatetimeTest(TestCase):
@@ -114,6 +132,16 @@ class DatetimeTest(TestCase):
         self.assertEquals(datetime.datetime(2012,1,1,0,0), dt_list[0])
         self.assertEquals(datetime.datetime(2012,1,31,23,50), dt_list[-1])
 
+    def testDatetimes64(self):
+        filename = "/tmp/weabase/data/nnsc/nnsc0112.wea"
+        wea = WeaFile(filename)
+        dts = wea.get_datetimes64()
+        self.assertEquals(dtype('datetime64[m]'), dts.dtype)
+        self.assertEquals(wea.get_datetimes(),
+                          dts.astype(datetime.datetime).tolist())
+        self.assertEquals(datetime.datetime(2012,1,1,0,10),
+                          dts[1].astype(datetime.datetime))
+
     def testYearsArray(self):
         filename = "/tmp/weabase/data/nnsc/nnsc0112.wea"
         wea = WeaFile(filename)
@@ -193,6 +221,44 @@ class DatetimeTest(TestCase):
         # Check that the mean temp is calculated correctly.
         self.assertEquals("51.5", "%.1f" % data.mean())
 
+    def testVarDtype(self):
+        w = WeaArray('nnsc',
+                     datetime.datetime(2011, 12, 31),
+                     datetime.datetime(2012, 1, 31, 23, 50),
+                     units_system='E')
+        self.assertEquals(w.get_var('AVA').dtype, dtype('<f4'))
+        self.assertEquals(w.get_var('AVA', dtype='f8').dtype, dtype('f8'))
+
+    def testConvertKeepsMissing(self):
+        sD = datetime.datetime(2011, 12, 31)
+        eD = datetime.datetime(2012, 1, 31, 23, 50)
+        native = WeaArray('nnsc', sD, eD).get_var('AVA')
+        english = WeaArray('nnsc', sD, eD, units_system='E').get_var('AVA')
+        missing = missing_mask(native)
+        self.assertTrue((native[missing] == english[missing]).all())
+        self.assertTrue((english[~missing] ==
+                         native[~missing] * dtype('<f4').type(1.8) + 32).all())
+
+    def testGetDatetimes(self):
+        w = WeaArray('nnsc', datetime.datetime(2011, 12, 31, 23, 30),
+                     datetime.datetime(2012, 1, 1, 0, 20))
+        dts = w.get_datetimes().astype(datetime.datetime).tolist()
+        self.assertEquals(len(w.get_var('TIM')), len(dts))
+        self.assertEquals(datetime.datetime(2011, 12, 31, 23, 30), dts[0])
+        self.assertEquals(datetime.datetime(2012, 1, 1, 0, 20), dts[-1])
+
+    def testGetVars(self):
+        w = WeaArray('nnsc',
+                     datetime.datetime(2011, 12, 31, 12),
+                     datetime.datetime(2012, 2, 1, 6, 30),
+                     units_system='E')
+        block, pcodes = w.get_vars(['TIM', 'AVA', 'years'])
+        self.assertEquals(pcodes, ('TIM', 'AVA', 'YEARS'))
+        self.assertEquals(block.shape, (len(w.get_var('TIM')), 3))
+        for j, pcode in enumerate(pcodes):
+            self.assertTrue((block[:, j] == w.get_var(pcode)).all())
+        self.assertRaises(ValueError, w.get_vars, ['AVA', 'FOO'])
+
     def testLatestData(self):
         filename = "/tmp/weabase/data/nnsc/nnsc0112.wea"
         wea = WeaFile(filename)
@@ -230,6 +296,797 @@ class OpenFileTest(TestCase):
         self.assertEquals(12, len(w.weafiles))
 
 
+class FileCacheTest(TestCase):
+    def setUp(self):
+        self.cache = WeaFileCache(max_files=2)
+        self.filenames = [
+            "/tmp/weabase/data/nnsc/nnsc%02d11.wea" % m for m in (1, 2, 3)]
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def testHit(self):
+        wea = self.cache.get(self.filenames[0])
+        self.assertTrue(wea is self.cache.get(self.filenames[0]))
+        stats = self.cache.stats()
+        self.assertEquals(1, stats['misses'])
+        self.assertEquals(1, stats['hits'])
+
+    def testReloadOnChange(self):
+        filename = self.filenames[0]
+        wea = self.cache.get(filename)
+        st = os.stat(filename)
+        os.utime(filename, (st.st_atime, st.st_mtime + 1))
+        try:
+            self.assertFalse(wea is self.cache.get(filename))
+            self.assertEquals(1, self.cache.stats()['reloads'])
+        finally:
+            os.utime(filename, (st.st_atime, st.st_mtime))
+
+    def testEviction(self):
+        for filename in self.filenames:
+            self.cache.get(filename)
+        stats = self.cache.stats()
+        self.assertEquals(2, stats['files'])
+        self.assertEquals(1, stats['evictions'])
+
+    def testMissingFile(self):
+        self.assertRaises(IOError, self.cache.get,
+                          "/tmp/weabase/data/nnsc/nnsc0199.wea")
+
+
+class StationIndexTest(TestCase):
+    def setUp(self):
+        self.index = StationIndex('nnsc')
+
+    def testMonths(self):
+        self.assertEquals(WeaMeta('nnsc').get_date_list(),
+                          self.index.months())
+
+    def testHeader(self):
+        wea = WeaFile("/tmp/weabase/data/nnsc/nnsc0112.wea", readdata=False)
+        entry = self.index.entry((2012, 1))
+        self.assertEquals(wea.read_header(), entry['header'])
+        self.assertEquals(wea.header_size(), entry['offset'])
+        self.assertEquals(4464, entry['rows'])
+        self.assertRaises(IOError, self.index.entry, (1900, 1))
+
+    def testPersist(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            shutil.copy("/tmp/weabase/data/nnsc/nnsc0112.wea", tmp)
+            index = StationIndex('nnsc', data_dir=tmp, persist=True)
+            header = index.header((2012, 1))
+            self.assertTrue(os.path.exists(index.sidecar_filename()))
+            loaded = StationIndex('nnsc', data_dir=tmp, persist=True)
+            self.assertEquals(header, loaded.entries[(2012, 1)]['header'])
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TimeIndexTest(TestCase):
+    def setUp(self):
+        self.dir = os.path.join(settings.DATAPATH, 'zgap')
+        os.mkdir(self.dir)
+        source = WeaFile("/tmp/weabase/data/nnsc/nnsc0112.wea")
+        self.source = source
+        # Rows 10 to 19 are absent and the month stops after row 499.
+        self.kept = range(10) + range(20, 500)
+        with open(os.path.join(self.dir, "zgap0112.wea"), 'wb') as f:
+            f.write(open(source.filename, 'rb').read()[:source.header_size()])
+            f.write(source.data[self.kept].tobytes())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testGap(self):
+        w = WeaArray('zgap', datetime.datetime(2012, 1, 1, 1),
+                     datetime.datetime(2012, 1, 1, 4))
+        expected = [self.source.data[i, 1] for i in range(6, 25)
+                    if i in self.kept]
+        self.assertEquals(expected, list(w.get_var('TIM')))
+
+    def testTruncated(self):
+        w = WeaArray('zgap', datetime.datetime(2012, 1, 4),
+                     datetime.datetime(2012, 1, 31, 23, 50))
+        self.assertEquals(500 - 432, w.num_rows())
+        w = WeaArray('zgap', datetime.datetime(2012, 1, 10),
+                     datetime.datetime(2012, 1, 31, 23, 50))
+        self.assertEquals(0, len(w.get_var('AVA')))
+
+
+class MixedTest(TestCase):
+    def setUp(self):
+        self.dir = os.path.join(settings.DATAPATH, 'zmix')
+        os.mkdir(self.dir)
+        shutil.copy("/tmp/weabase/data/nnsc/nnsc0112.wea",
+                    os.path.join(self.dir, "zmix0112.wea"))
+        # December is every third row, at a 30 minute oi, without PRE.
+        source = WeaFile("/tmp/weabase/data/nnsc/nnsc1211.wea")
+        pcodes = list(source.header['pcodes'])
+        keep = [j for j, p in enumerate(pcodes) if p != 'PRE']
+        fixed = list(struct.unpack("<hf4h8h", open(source.filename, 'rb')
+                                   .read(30)))
+        fixed[2], fixed[3] = 30, len(keep)
+        self.dec = source.data[::3][:, keep]
+        self.dec_pcodes = [pcodes[j] for j in keep]
+        with open(os.path.join(self.dir, "zmix1211.wea"), 'wb') as f:
+            f.write(struct.pack("<hf4h8h", *fixed))
+            f.write(''.join(pcodes[j] for j in keep))
+            f.write(self.dec.tobytes())
+        self.w = WeaArray('zmix', datetime.datetime(2011, 12, 31, 23),
+                          datetime.datetime(2012, 1, 1, 0, 30))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testGrid(self):
+        self.assertTrue(self.w.is_mixed())
+        self.assertEquals(10, self.w.get_oi())
+        tim = list(self.w.get_var('TIM'))
+        self.assertEquals([2300, 2310, 2320, 2330, 2340, 2350,
+                           0, 10, 20, 30], tim)
+        ava = self.w.get_var('AVA')
+        j = self.dec_pcodes.index('AVA')
+        self.assertEquals(self.dec[-2, j], ava[0])
+        self.assertEquals([10000000.0] * 2, list(ava[1:3]))
+        self.assertEquals(self.dec[-1, j], ava[3])
+        self.assertEquals([10000000.0] * 2, list(ava[4:6]))
+        self.assertEquals(len(tim), self.w.num_rows())
+        self.assertEquals(len(tim), len(self.w.get_datetimes()))
+
+    def testStartInsideStep(self):
+        # No row before sD, though December's 23:00 step covers it.
+        w = WeaArray('zmix', datetime.datetime(2011, 12, 31, 23, 10),
+                     datetime.datetime(2012, 1, 1, 0, 10))
+        self.assertEquals([2310, 2320, 2330, 2340, 2350, 0, 10],
+                          list(w.get_var('TIM')))
+        self.assertEquals(7, w.num_rows())
+
+    def testAbsentElement(self):
+        pre = self.w.get_var('PRE')
+        self.assertEquals([10000000.0] * 6, list(pre[:6]))
+        self.assertEquals(list(WeaArray('nnsc', datetime.datetime(2012, 1, 1),
+            datetime.datetime(2012, 1, 1, 0, 30)).get_var('PRE')),
+            list(pre[6:]))
+        self.assertRaises(ValueError, self.w.get_var, 'FOO')
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ResponseCache(max_bytes=10, directory=self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testEtag(self):
+        self.cache.put('a', CachedResponse('e1', 'abc', 'text/plain'))
+        self.assertEquals('abc', self.cache.get('a', 'e1').body)
+        self.assertEquals(None, self.cache.get('a', 'e2'))
+
+    def testEvict(self):
+        self.cache.put('a', CachedResponse('e', '123456', 'text/plain'))
+        self.cache.put('b', CachedResponse('e', '123456', 'text/plain'))
+        self.cache.put('c', CachedResponse('e', '12345678901', 'text/plain'))
+        self.assertEquals(1, len(self.cache))
+        self.assertEquals(1, self.cache.stats()['evictions'])
+
+    def testDisk(self):
+        self.cache.put('a', CachedResponse('e', 'abc', 'text/csv',
+                                           {'X-Wea-Meta': '{}'}))
+        loaded = ResponseCache(directory=self.dir).get('a', 'e')
+        self.assertEquals('abc', loaded.body)
+        self.assertEquals('text/csv', loaded.mimetype)
+        self.assertEquals({'X-Wea-Meta': '{}'}, loaded.headers)
+
+    def testOldFormat(self):
+        # A file written before encoded bodies were kept.
+        self.cache.put('a', CachedResponse('e', 'abc', 'text/plain'))
+        filename = os.path.join(self.dir, os.listdir(self.dir)[0])
+        meta, body = open(filename, 'rb').read().split('\n', 1)
+        meta = json.loads(meta)
+        del meta['encoded']
+        with open(filename, 'wb') as f:
+            f.write(json.dumps(meta) + '\n' + body)
+        self.assertEquals('abc', ResponseCache(directory=self.dir)
+                          .get('a', 'e').body)
+        with open(filename, 'wb') as f:
+            f.write('{"key": %s}\n' % json.dumps(repr('a')))
+        self.assertEquals(None, ResponseCache(directory=self.dir)
+                          .get('a', 'e'))
+
+    def testDiskBound(self):
+        cache = ResponseCache(directory=self.dir)
+        cache.put('a', CachedResponse('e', 'x' * 100, 'text/plain'))
+        size = cache.stats()['disk_bytes']
+        cache.disk_max_bytes = 2 * size
+        for key in 'bc':
+            cache.get('a', 'e')  # keep a in use
+            cache.put(key, CachedResponse('e', 'x' * 100, 'text/plain'))
+        self.assertEquals(2, len(os.listdir(self.dir)))
+        self.assertEquals(2 * size, cache.stats()['disk_bytes'])
+        cache.clear()
+        self.assertEquals(None, cache.get('b', 'e'))
+        self.assertEquals('x' * 100, cache.get('a', 'e').body)
+
+
+class CompressionTest(TestCase):
+    def testCompress(self):
+        import zlib
+        data = '"10000000.0", ' * 1000
+        self.assertEquals(data, zlib.decompress(
+            compression.compress(data, 'gzip'), 16 + zlib.MAX_WBITS))
+        self.assertEquals(data, zlib.decompress(
+            compression.compress(data, 'deflate')))
+        chunks = compression.iter_compress([data[:100], data[100:]], 'gzip')
+        self.assertEquals(data, zlib.decompress(''.join(chunks),
+                                                16 + zlib.MAX_WBITS))
+
+    def testEncodedOnce(self):
+        cache = ResponseCache()
+        entry = CachedResponse('e', 'abc', 'text/plain')
+        cache.put('a', entry)
+        cache.add_encoding('a', entry, 'gzip',
+                           compression.compress('abc', 'gzip'))
+        self.assertEquals(entry.size(), cache.stats()['bytes'])
+        response = cache.get('a', 'e').response('gzip')
+        self.assertEquals('gzip', response.headers['Content-Encoding'])
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.registry = list(metrics.registry)
+
+    def tearDown(self):
+        metrics.registry[:] = self.registry
+
+    def testCounter(self):
+        c = metrics.Counter('test_total', 'A test.', ('kind',))
+        c.inc(1, 'a')
+        c.inc(2, 'a')
+        self.assertTrue('# TYPE test_total counter\ntest_total{kind="a"} 3\n'
+                        in metrics.render())
+
+    def testHistogram(self):
+        h = metrics.Histogram('test_seconds', 'A test.', buckets=(0.1, 1))
+        h.observe(0.5)
+        h.observe(2.0)
+        text = metrics.render()
+        self.assertTrue('test_seconds_bucket{le="0.1"} 0\n' in text)
+        self.assertTrue('test_seconds_bucket{le="1"} 1\n' in text)
+        self.assertTrue('test_seconds_bucket{le="+Inf"} 2\n' in text)
+        self.assertTrue('test_seconds_count 2\n' in text)
+
+    def testTimedGenerator(self):
+        @metrics.timed('test')
+        def gen():
+            yield 1
+            yield 2
+        self.assertEquals([1, 2], list(gen()))
+        self.assertTrue('wea_stage_seconds_count{stage="test"} 1\n'
+                        in metrics.render())
+
+    def testStages(self):
+        def counts():
+            values = metrics.stage_seconds.values
+            return dict((k[0], v[2]) for k, v in values.items())
+        sD = datetime.datetime(2012, 1, 1)
+        eD = datetime.datetime(2012, 1, 2)
+        for run in (
+                lambda: ''.join(listers.getDataStream('nnsc', sD, eD)),
+                lambda: ''.join(listers.getDataExport(
+                    'nnsc', sD, eD, format='csv')[1]),
+                lambda: ''.join(listers.getDataExport(
+                    'nnsc', sD, eD, format='bin')[1])):
+            before = counts()
+            run()
+            after = counts()
+            for stage in ('slice', 'serialize'):
+                self.assertTrue(after.get(stage, 0) > before.get(stage, 0))
+
+
+class ProfilingTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def client(self, **config):
+        from werkzeug.test import Client
+        from werkzeug.wrappers import BaseResponse
+        return Client(application.create_app(config), BaseResponse)
+
+    def testRequested(self):
+        c = self.client(PROFILE_SECRET='s', PROFILE_DIR=self.dir)
+        r = c.get('/getStnDates?stn=nnsc&profile=s')
+        self.assertTrue('function calls' in r.data)
+        r = c.get('/getStnDates?stn=nnsc&profile=x')
+        self.assertEquals('nnsc', json.loads(r.data)['stn'])
+        self.assertEquals(1, len(profiling.saved_profiles(self.dir)))
+
+    def testRequestedNotCached(self):
+        c = self.client(PROFILE_SECRET='s')
+        url = '/getData?stn=nnsc&sD=2011-12-7-15&eD=2011-12-7-16'
+        c.get(url)
+        for i in range(2):
+            r = c.get(url + '&profile=s')
+            self.assertTrue('getDataJson' in r.data)
+
+    def testSampled(self):
+        c = self.client(PROFILE_SAMPLE_RATE=1.0, PROFILE_DIR=self.dir,
+                        PROFILE_KEEP=2)
+        for i in range(3):
+            r = c.get('/getStnDates?stn=nnsc')
+            self.assertEquals('nnsc', json.loads(r.data)['stn'])
+        self.assertEquals(2, len(profiling.saved_profiles(self.dir)))
+        out = StringIO()
+        stats = profiling.aggregate(self.dir, stream=out)
+        self.assertTrue(stats.total_calls > 0)
+
+    def testDisabled(self):
+        app = application.create_app()
+        self.assertFalse(isinstance(app.wsgi_app,
+                                    profiling.ProfilerMiddleware))
+
+
+class SynthTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testLayout(self):
+        stn_dir = synth.make_station(self.dir, 'synt', [2012], oi=15, ne=12,
+                                     missing=0.1)
+        self.assertEquals(12, len(os.listdir(stn_dir)))
+        wea = WeaFile(os.path.join(stn_dir, 'synt0212.wea'))
+        self.assertEquals(15, wea.header['oi'])
+        self.assertEquals(synth.PCODES[:12], wea.header['pcodes'])
+        self.assertEquals((29 * 96, 12), wea.data.shape)
+        self.assertEquals(datetime.datetime(2012, 2, 29, 23, 45),
+                          wea.get_datetimes()[-1])
+        fraction = missing_mask(wea.data[:, 2:]).mean()
+        self.assertTrue(0.05 < fraction < 0.15)
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.dir = synth.make_station(settings.DATAPATH, 'zarc', [2010],
+                                      ne=8, missing=0.1)
+        self.sD = datetime.datetime(2010, 1, 1)
+        self.eD = datetime.datetime(2010, 12, 31, 23, 50)
+        self.expected = WeaArray('zarc', self.sD, self.eD).get_var('MWD')
+        self.assertEquals(11, archive.pack_station('zarc', (2010, 12)))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testRead(self):
+        w = WeaArray('zarc', self.sD, self.eD)
+        self.assertTrue(all(isinstance(wea, archive.ArchiveMonth)
+                            for wea in w.weafiles[:-1]))
+        self.assertFalse(isinstance(w.weafiles[-1], archive.ArchiveMonth))
+        self.assertEquals(list(self.expected), list(w.get_var('MWD')))
+        self.assertEquals((2010, 2), w.weafiles[1].yearmonth())
+
+    def testPacked(self):
+        # Months whose .wea file is gone are still read from the archive.
+        os.remove(os.path.join(self.dir, 'zarc0310.wea'))
+        index = get_station_index('zarc')
+        self.assertEquals(12, len(index.months()))
+        w = WeaArray('zarc', self.sD, self.eD)
+        self.assertEquals(list(self.expected), list(w.get_var('MWD')))
+
+    def testChanged(self):
+        # A .wea file changed since packing is read instead.
+        filename = os.path.join(self.dir, 'zarc0510.wea')
+        synth.write_wea(filename, 2010, 5, pcodes=synth.PCODES[:8], seed=1)
+        index = get_station_index('zarc')
+        entry = index.entry((2010, 5))
+        self.assertFalse('archive' in entry)
+        self.assertEquals(filename, archive.open_entry(entry).filename)
+        self.assertTrue('archive' in index.entry((2010, 4)))
+        # Packing again takes the changed month.
+        archive.pack_station('zarc', (2010, 12))
+        may = index.entry((2010, 5))
+        self.assertTrue('archive' in may)
+        self.assertEquals(synth.month_block(2010, 5, pcodes=synth.PCODES[:8],
+                                            seed=1)[:, 5].tolist(),
+                          archive.open_entry(may).data[:, 5].tolist())
+
+    def testTrusted(self):
+        # Trusted, closed months are planned without looking at their
+        # .wea files, until a refresh finds them changed.
+        module = sys.modules[StationIndex.__module__]
+        file_stamp = module.file_stamp
+        stamped = []
+        def counting_stamp(filename):
+            stamped.append(os.path.basename(filename))
+            return file_stamp(filename)
+        trust = module.ARCHIVE_TRUST
+        module.file_stamp = counting_stamp
+        module.ARCHIVE_TRUST = True
+        index = get_station_index('zarc')
+        try:
+            entries = index.plan([(2010, m) for m in range(1, 13)])
+            self.assertEquals(11, sum('archive' in e for e in entries))
+            self.assertEquals(['zarc.archive', 'zarc1210.wea'], stamped)
+
+            synth.write_wea(os.path.join(self.dir, 'zarc0510.wea'),
+                            2010, 5, pcodes=synth.PCODES[:8], seed=1)
+            self.assertTrue('archive' in index.entry((2010, 5)))
+            months = [(2010, 4), (2010, 5)]
+            for refresh in (True, False):
+                april, may = index.plan(months, refresh=refresh)
+                self.assertTrue('archive' in april)
+                self.assertFalse('archive' in may)
+        finally:
+            module.file_stamp = file_stamp
+            module.ARCHIVE_TRUST = trust
+
+
+class MissingModeTest(TestCase):
+    def setUp(self):
+        self.dir = synth.make_station(settings.DATAPATH, 'zmis', [2010],
+                                      ne=12, missing=0.1)
+        self.sD = datetime.datetime(2010, 1, 20)
+        self.eD = datetime.datetime(2010, 3, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testFileMask(self):
+        wea = WeaFile(os.path.join(self.dir, 'zmis0110.wea'))
+        self.assertEquals(missing_mask(wea.data[5:9, 3]).tolist(),
+                          wea.missing_mask(slice(5, 9), 3).tolist())
+        self.assertTrue(wea._mask is None)
+        mask = wea.missing_mask(cache=True)
+        self.assertTrue(wea._mask is not None)
+        self.assertFalse(mask.flags.writeable)
+        self.assertEquals(list(missing_mask(wea.data).ravel()),
+                          list(mask.ravel()))
+
+    def testMaskNotKept(self):
+        WeaArray('zmis', self.sD, self.eD, 'E').get_vars(('AVA', 'MXA'))
+        wea = open_weafile(os.path.join(self.dir, 'zmis0210.wea'))
+        self.assertTrue(wea._mask is None)
+        WeaArray('zmis', self.sD, self.eD, missing='nan').get_var('AVA')
+        self.assertTrue(wea._mask is not None)
+
+    def testLastValidRow(self):
+        wea = WeaFile(os.path.join(self.dir, 'zmis0310.wea'))
+        valid = ~missing_mask(wea.data[:, 2:]).all(axis=1)
+        self.assertEquals(int(flatnonzero(valid)[-1]),
+                          wea.last_valid_row())
+
+    def testModes(self):
+        for units in 'NE':
+            plain = WeaArray('zmis', self.sD, self.eD, units).get_var('AVA')
+            missing = missing_mask(plain)
+            self.assertTrue(missing.any())
+            w = WeaArray('zmis', self.sD, self.eD, units, missing='masked')
+            masked = w.get_var('AVA')
+            self.assertEquals(list(missing), list(ma.getmaskarray(masked)))
+            self.assertEquals(list(plain), list(masked.filled()))
+            w = WeaArray('zmis', self.sD, self.eD, units, missing='nan')
+            nans = w.get_var('AVA')
+            self.assertEquals(list(missing), list(isnan(nans)))
+            self.assertEquals(list(plain[~missing]), list(nans[~missing]))
+
+    def testBlocks(self):
+        w = WeaArray('zmis', self.sD, self.eD, 'E')
+        plain, pcodes = w.get_vars(('AVA', 'MXA', 'YEARS'))
+        w = WeaArray('zmis', self.sD, self.eD, 'E', missing='masked')
+        block = w.get_vars(('AVA', 'MXA', 'YEARS'))[0]
+        self.assertEquals(plain.tolist(), ma.getdata(block).tolist())
+        self.assertEquals(missing_mask(plain).tolist(),
+                          ma.getmaskarray(block).tolist())
+        self.assertEquals(format_column(plain[:, 0], '%.1f', ''),
+                          format_column(block[:, 0], '%.1f', ''))
+        self.assertEquals(format_column_json(plain[:, 1], '%.1f'),
+                          format_column_json(block[:, 1], '%.1f'))
+
+    def testUnknown(self):
+        self.assertRaises(ValueError, WeaArray, 'zmis', self.sD, self.eD,
+                          missing='zero')
+
+    def testStats(self):
+        for units in 'NEM':
+            w = WeaArray('zmis', self.sD, self.eD, units)
+            for pcode in ('AVA', 'MXA'):
+                values = w.get_var(pcode, dtype='f8')
+                values = values[~missing_mask(values)]
+                result = stats.range_stats(w, pcode)
+                self.assertEquals(len(values), result['count'])
+                self.assertAlmostEquals(values.min(), result['min'], 4)
+                self.assertAlmostEquals(values.max(), result['max'], 4)
+                self.assertAlmostEquals(values.mean(), result['mean'], 4)
+                self.assertAlmostEquals(values.sum(), result['total'], 1)
+
+    def testStatsEmpty(self):
+        stn_dir = synth.make_station(settings.DATAPATH, 'zemp', [2010],
+                                     ne=4, missing=1.0)
+        try:
+            result = listers.getStats('zemp', self.sD, self.eD,
+                                      elements=['MWS'])
+        finally:
+            shutil.rmtree(stn_dir)
+        mws = result['data']['MWS']
+        self.assertEquals(0, mws['count'])
+        self.assertEquals((None, None, None),
+                          (mws['min'], mws['max'], mws['mean']))
+        self.assertEquals(listers._var_format('MWS') % 0.0, mws['total'])
+
+    def testStatsMissing(self):
+        w = WeaArray('zmis', self.sD, self.eD)
+        self.assertRaises(ValueError, stats.range_stats, w, 'FOO')
+        self.assertEquals(None, stats.combine([None, None]))
+        self.assertEquals((-2.0, 5.0, 7.0, 5),
+                          stats.combine([(1.0, 5.0, 9.0, 3), None,
+                                         (-2.0, 0.0, -2.0, 2)]))
+
+
+class LatestTest(TestCase):
+    def setUp(self):
+        self.dir = os.path.join(settings.DATAPATH, 'zlat')
+        os.mkdir(self.dir)
+        shutil.copy("/tmp/weabase/data/nnsc/nnsc1211.wea",
+                    os.path.join(self.dir, "zlat1211.wea"))
+        source = WeaFile("/tmp/weabase/data/nnsc/nnsc0112.wea")
+        self.offset = source.header_size()
+        self.rowsize = 4 * source.header['ne']
+        self.rows = open(source.filename, 'rb').read()[self.offset:]
+        # January starts with a day of missing data.
+        self.missing = source.data[:144].copy()
+        self.missing[:, 2:] = 10000000.0
+        self.filename = os.path.join(self.dir, "zlat0112.wea")
+        with open(self.filename, 'wb') as f:
+            f.write(open(source.filename, 'rb').read()[:self.offset])
+            f.write(self.missing.tobytes())
+        self.tracker = LatestTracker()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testFallBack(self):
+        wea, row = self.tracker.latest('zlat')
+        self.assertEquals((2011, 12), wea.yearmonth())
+        self.assertEquals(len(wea.data) - 1, row)
+
+    def testAppend(self):
+        self.tracker.latest('zlat')
+        with open(self.filename, 'ab') as f:
+            f.write(self.rows[144 * self.rowsize:200 * self.rowsize])
+        os.utime(self.filename, (0, 0))
+        wea, row = self.tracker.latest('zlat')
+        self.assertEquals((2012, 1), wea.yearmonth())
+        self.assertEquals(199, row)
+        self.assertEquals(wea.last_valid_row(), row)
+        self.assertEquals((wea, row), self.tracker.latest('zlat'))
+        self.assertEquals((2011, 12), self.tracker.latest(
+            'zlat', (2011, 12))[0].yearmonth())
+
+    def testEntries(self):
+        # January has no valid row, so December is read too.
+        entries = self.tracker.entries('zlat')
+        self.assertEquals([self.filename,
+                           os.path.join(self.dir, "zlat1211.wea")],
+                          [e['filename'] for e in entries])
+        self.assertEquals(1, len(self.tracker.entries('zlat', (2011, 12))))
+
+    def testMostRecentYear(self):
+        result = listers.getMostRecentData('zlat')
+        self.assertEquals([2011, 12, 31, 23, 50], list(result['eD']))
+
+
+class ListersTest(TestCase):
+    def setUp(self):
+        self.sD = datetime.datetime(2011, 12, 31, 12)
+        self.eD = datetime.datetime(2012, 2, 1, 6, 30)
+
+    def testStreamMatchesGetData(self):
+        for units_system in ('N', 'E'):
+            result = listers.getData('nnsc', self.sD, self.eD,
+                                     units_system=units_system)
+            chunks = listers.getDataStream('nnsc', self.sD, self.eD,
+                                           units_system=units_system)
+            self.assertEquals(json.dumps(result), ''.join(chunks))
+            self.assertEquals(json.dumps(result), listers.getDataJson(
+                'nnsc', self.sD, self.eD, units_system=units_system))
+
+    def testElements(self):
+        result = listers.getData('nnsc', self.sD, self.eD,
+                                 elements=['ava', 'PRE'])
+        self.assertEquals(set(['AVA', 'PRE']), set(result['data']))
+        self.assertEquals(set(['AVA', 'PRE']), set(result['units']))
+        full = listers.getData('nnsc', self.sD, self.eD)
+        self.assertEquals(full['data']['AVA'], result['data']['AVA'])
+        self.assertRaises(ValueError, listers.getData, 'nnsc',
+                          self.sD, self.eD, elements=['AVA', 'FOO'])
+
+    def testStats(self):
+        result = listers.getStats('nnsc', self.sD, self.eD, units_system='E',
+                                  elements=['AVA', 'PRE'])
+        self.assertEquals(['AVA', 'PRE'], sorted(result['data']))
+        self.assertFalse('years' in result)
+        data = listers.getData('nnsc', self.sD, self.eD, units_system='E',
+                               elements=['AVA'])['data']['AVA']
+        values = [float(v) for v in data if v is not None]
+        ava = result['data']['AVA']
+        self.assertEquals(len(values), ava['count'])
+        self.assertEquals('%.1f' % max(values), ava['max'])
+        self.assertEquals('%.1f' % min(values), ava['min'])
+        self.assertRaises(ValueError, listers.getStats, 'nnsc', self.sD,
+                          self.eD, elements=['DAY'])
+
+    def testMulti(self):
+        text = listers.getDataMulti(['nnsc', 'nope', 'nnsc'], self.sD,
+                                    self.eD, elements=['AVA'])
+        self.assertEquals('{"nnsc": %s, "nope": {"error": "No data available."}}'
+            % listers.getDataJson('nnsc', self.sD, self.eD, elements=['AVA']),
+            text)
+
+    def testMultiErrors(self):
+        def func(stn):
+            if stn == 'bad':
+                raise AttributeError(stn)
+            return '1'
+        self.assertEquals('{"a": 1, "bad": {"error": "Internal error."}}',
+                          listers._run_multi(['a', 'bad'], func))
+        limit = listers.MULTI_MAX_STATIONS
+        listers.MULTI_MAX_STATIONS = 1
+        try:
+            self.assertRaises(ValueError, listers._run_multi,
+                              ['a', 'b'], func)
+            self.assertEquals('{"a": 1}', listers._run_multi(['a', 'a'], func))
+        finally:
+            listers.MULTI_MAX_STATIONS = limit
+
+    def testExportBin(self):
+        meta, chunks = listers.getDataExport('nnsc', self.sD, self.eD,
+                                             format='bin')
+        data = ''.join(chunks)
+        n = struct.unpack('<I', data[:4])[0]
+        self.assertEquals(json.loads(json.dumps(meta)),
+                          json.loads(data[4:4 + n]))
+        block = frombuffer(data[4 + n:], dtype='<f4').reshape(meta['shape'])
+        w = WeaArray('nnsc', self.sD, self.eD)
+        self.assertEquals(meta['columns'][-1], 'YEARS')
+        self.assertTrue((block[:, 1] == w.get_var('TIM')).all())
+        self.assertTrue((block[:, -1] == w.get_var('YEARS')).all())
+
+    def testExportCsv(self):
+        meta, chunks = listers.getDataExport('nnsc', self.sD, self.eD,
+                                             format='csv')
+        lines = ''.join(chunks).splitlines()
+        self.assertEquals(','.join(meta['columns']), lines[0])
+        self.assertEquals(meta['shape'][0], len(lines) - 1)
+        self.assertRaises(ValueError, listers.getDataExport,
+                          'nnsc', self.sD, self.eD, format='xml')
+
+    def testExportCsvMatchesData(self):
+        for interval in (None, 'daily'):
+            meta, chunks = listers.getDataExport(
+                'nnsc', self.sD, self.eD, units_system='E', format='csv',
+                elements=['AVA', 'PRE'], interval=interval)
+            rows = [line.split(',') for line in
+                    ''.join(chunks).splitlines()[1:]]
+            data = listers.getData('nnsc', self.sD, self.eD,
+                                   units_system='E', elements=['AVA', 'PRE'],
+                                   interval=interval)['data']
+            for j, var in enumerate(['AVA', 'PRE']):
+                self.assertEquals([v or None for v in zip(*rows)[j]],
+                                  data[var])
+
+    def testFormatColumn(self):
+        values = array([1.25, 10000000.0, -3.0, 2.0])
+        self.assertEquals(['1.2', None, '-3.0', '2.0'],
+                          format_column(values, '%.1f'))
+        self.assertEquals('"1.2", null, "-3.0", "2.0"',
+                          format_column_json(values, '%.1f'))
+        self.assertEquals('', format_column_json(array([]), '%.1f'))
+
+
+class ResampleTest(TestCase):
+    def setUp(self):
+        self.w = WeaArray('nnsc',
+                          datetime.datetime(2011, 12, 31),
+                          datetime.datetime(2012, 1, 1, 23, 50))
+
+    def testRules(self):
+        self.assertEquals('sum', rule_for('PRE'))
+        self.assertEquals('max', rule_for('MXA'))
+        self.assertEquals('min', rule_for('MNR'))
+        self.assertEquals('vector_mean', rule_for('MWD'))
+        self.assertEquals('mean', rule_for('AVA'))
+
+    def testAggregate(self):
+        values = array([1.0, 3.0, 10000000.0, 10000000.0, 5.0])
+        starts = array([0, 2, 4])
+        self.assertEquals([2.0, 10000000.0, 5.0],
+                          list(aggregate(values, starts, 'mean')))
+        self.assertEquals([4.0, 10000000.0, 5.0],
+                          list(aggregate(values, starts, 'sum')))
+        self.assertEquals([3.0, 10000000.0, 5.0],
+                          list(aggregate(values, starts, 'max')))
+        self.assertEquals(["0"], ["%.0f" % v for v in aggregate(
+            array([350.0, 10.0]), array([0]), 'vector_mean') % 360])
+
+    def testDaily(self):
+        chunks = list(iter_resampled(self.w, ['DAY', 'AVA'], 'daily'))
+        self.assertEquals([365, 1], [int(c[0, 0]) for c in chunks])
+        ava = self.w.get_var('AVA')[:144]
+        ava = ava[~missing_mask(ava)]
+        self.assertAlmostEquals(ava.mean(), chunks[0][0, 1], places=3)
+
+    def testHourly(self):
+        chunks = list(iter_resampled(self.w, ['TIM', 'AVA'], 'hourly'))
+        self.assertEquals(48, sum(len(c) for c in chunks))
+        self.assertEquals(range(0, 2400, 100), list(chunks[0][:, 0]))
+
+
+class SummaryTest(TestCase):
+    def setUp(self):
+        self.sD = datetime.datetime(2011, 12, 31)
+        self.eD = datetime.datetime(2012, 1, 1, 23, 50)
+        self.dir = os.path.join(settings.DATAPATH, 'nnsc', 'summary')
+        shutil.rmtree(self.dir, True)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, True)
+
+    def testChooseLevel(self):
+        self.assertEquals('daily', summary.choose_level('daily'))
+        self.assertEquals('monthly', summary.choose_level('monthly'))
+        self.assertRaises(ValueError, summary.choose_level, 'weekly')
+
+    def testNotLazyByDefault(self):
+        ym = (2012, 1)
+        summary.get_summary('nnsc', ym, 'daily')
+        self.assertFalse(os.path.exists(
+            summary.summary_filename('nnsc', ym, 'daily')))
+
+    def testLazyBuild(self):
+        ym = (2012, 1)
+        filename = summary.summary_filename('nnsc', ym, 'daily')
+        pcodes, block = summary.get_summary('nnsc', ym, 'daily', lazy=False)
+        self.assertFalse(os.path.exists(filename))
+        pcodes, block = summary.get_summary('nnsc', ym, 'daily', lazy=True)
+        self.assertTrue(os.path.exists(filename))
+        source = get_station_index('nnsc').entry(ym)['filename']
+        self.assertAlmostEquals(os.stat(source).st_mtime,
+                                os.stat(filename).st_mtime, places=3)
+        cached, data = summary.get_summary('nnsc', ym, 'daily')
+        self.assertEquals(list(pcodes), list(cached))
+        self.assertEquals(block.astype('<f4').tolist(), data.tolist())
+
+    def testStale(self):
+        ym = (2012, 1)
+        filename = summary.summary_filename('nnsc', ym, 'daily')
+        summary.get_summary('nnsc', ym, 'daily', lazy=True)
+        os.utime(filename, (0, 0))
+        summary.get_summary('nnsc', ym, 'daily', lazy=True)
+        source = get_station_index('nnsc').entry(ym)['filename']
+        self.assertAlmostEquals(os.stat(source).st_mtime,
+                                os.stat(filename).st_mtime, places=3)
+
+    def testMatchesResample(self):
+        result = listers.getSummary('nnsc', self.sD, self.eD, 'daily',
+                                    elements=['DAY', 'AVA', 'PRE'])
+        w = WeaArray('nnsc', self.sD, self.eD)
+        block = concatenate(list(iter_resampled(w, ['AVA', 'PRE'],
+                                                'daily', 'f8')))
+        for j, var in enumerate(['AVA', 'PRE']):
+            self.assertEquals(
+                format_column(block[:, j], listers._var_format(var)),
+                result['data'][var])
+        self.assertEquals([2011, 2012], result['years'])
+        self.assertEquals('daily', result['level'])
+
+
 class LeapYearTest(TestCase):
     def setUp(self):
         pass
@@ -376,6 +1233,175 @@ class ServiceTest(TestCase):
         self.assertTrue("sD" in r)
         self.assertTrue("eD" in r)
 
+    def testStreamData(self):
+        params = {
+            "stn": 'nnsc',
+            "sD": '2011-12-30',
+            "eD": '2012-1-2',
+        }
+        r = self.make_request("/getData", params)
+        params["stream"] = '1'
+        self.assertEquals(r, self.make_request("/getData", params))
+
+    def testElements(self):
+        params = {
+            "stn": 'nnsc',
+            "sD": '2011-12-7-15',
+            "eD": '2011-12-7-16',
+            "elements": 'AVA,PRE',
+        }
+        r = self.make_request("/getData", params)
+        self.assertEquals(sorted(r["data"].keys()), ['AVA', 'PRE'])
+        params["elements"] = 'AVA,FOO'
+        r = self.make_request("/getData", params)
+        self.assertTrue("error" in r)
+
+    def testMulti(self):
+        params = {
+            "stn": 'nnsc,nope',
+            "sD": '2011-12-7-15',
+            "eD": '2011-12-7-16',
+        }
+        r = self.make_request("/getDataMulti", params)
+        self.assertEquals(r["nnsc"],
+                          self.make_request("/getData", dict(params, stn='nnsc')))
+        self.assertEquals(r["nope"], {"error": "No data available."})
+        r = self.make_request("/getMostRecentMulti", {"stn": 'nnsc,nope'})
+        self.assertTrue("data" in r["nnsc"])
+        self.assertTrue("error" in r["nope"])
+        r = self.make_request("/getDataMulti", dict(params, sD='bogus'))
+        self.assertEquals(["error"], r.keys())
+        r = self.make_request("/getMostRecentMulti",
+                              {"stn": 'nnsc', "eD": 'bogus'})
+        self.assertEquals(["error"], r.keys())
+
+    def testConditional(self):
+        params = {
+            "stn": 'nnsc',
+            "sD": '2011-12-7-15',
+            "eD": '2011-12-7-16',
+        }
+        r = requests.get(self.test_url + "/getData", params=params)
+        etag = r.headers['ETag']
+        self.assertTrue('max-age' in r.headers['Cache-Control'])
+        r2 = requests.get(self.test_url + "/getData", params=params,
+                          headers={'If-None-Match': etag})
+        self.assertEquals(304, r2.status_code)
+        self.assertEquals('', r2.content)
+        r2 = requests.get(self.test_url + "/getData", params=params,
+            headers={'If-Modified-Since': r.headers['Last-Modified']})
+        self.assertEquals(304, r2.status_code)
+        params["eD"] = '2012-1-1'
+        r2 = requests.get(self.test_url + "/getData", params=params,
+                          headers={'If-None-Match': etag})
+        self.assertEquals(200, r2.status_code)
+        # Errors carry no validators, and are not cached.
+        for i in range(2):
+            r = requests.get(self.test_url + "/getData",
+                             params=dict(params, elements='FOO'))
+            self.assertTrue('error' in r.json())
+            self.assertFalse('ETag' in r.headers)
+            self.assertFalse('max-age' in r.headers.get('Cache-Control', ''))
+        # The latest data is never historical, even from a closed month.
+        r = requests.get(self.test_url + "/getMostRecentData",
+                         params={'stn': 'nnsc', 'eD': '2011-12-31'})
+        self.assertTrue('ETag' in r.headers)
+        self.assertEquals('no-cache', r.headers['Cache-Control'])
+
+    def testOutputVersion(self):
+        from werkzeug.test import EnvironBuilder
+        request = EnvironBuilder('/getData', query_string='stn=nnsc') \
+            .get_request()
+        entries = get_station_index('nnsc').plan([(2011, 12)])
+        key = utils.query_key(request)
+        profiled = EnvironBuilder('/getData',
+                                  query_string='stn=nnsc&profile=x')
+        self.assertEquals(key, utils.query_key(profiled.get_request()))
+        etag = utils.file_validators(entries)[0]
+        version = utils.OUTPUT_VERSION
+        utils.OUTPUT_VERSION += 1
+        try:
+            self.assertNotEquals(key, utils.query_key(request))
+            self.assertNotEquals(etag, utils.file_validators(entries)[0])
+        finally:
+            utils.OUTPUT_VERSION = version
+
+    def testClosed(self):
+        def entries(d):
+            return [{'filename': 'nnsc%02d%02d.wea' % (d.month, d.year % 100)}]
+        now = datetime.datetime.now()
+        self.assertFalse(utils.is_closed(entries(now)))
+        grace = datetime.timedelta(seconds=utils.CLOSED_GRACE)
+        ended = now.replace(day=1) - datetime.timedelta(days=1)
+        self.assertEquals(now - grace >= now.replace(day=1, hour=0, minute=0,
+                                                     second=0, microsecond=0),
+                          utils.is_closed(entries(ended)))
+        earlier = ended.replace(day=1) - datetime.timedelta(days=1)
+        self.assertTrue(utils.is_closed(entries(earlier)))
+
+    def testCached(self):
+        params = {
+            "stn": 'nnsc',
+            "sD": '2011-12-30',
+            "eD": '2012-1-2',
+            "elements": 'AVA,PRE',
+        }
+        r = requests.get(self.test_url + "/getData", params=params)
+        r2 = requests.get(self.test_url + "/getData",
+                          params=dict(params, stn='NNSC', stream='1',
+                                      sD='2011-12-30-0-0'))
+        self.assertEquals(r.content, r2.content)
+        params["format"] = 'csv'
+        r = requests.get(self.test_url + "/getData", params=params)
+        r2 = requests.get(self.test_url + "/getData", params=params)
+        self.assertEquals(r.content, r2.content)
+        self.assertEquals(r.headers['Content-Type'],
+                          r2.headers['Content-Type'])
+
+    def testCompressed(self):
+        params = {
+            "stn": 'nnsc',
+            "sD": '2011-12-30',
+            "eD": '2012-1-2',
+        }
+        plain = requests.get(self.test_url + "/getData", params=params,
+                             headers={'Accept-Encoding': 'identity'})
+        self.assertFalse('Content-Encoding' in plain.headers)
+        for stream in ('0', '1'):
+            for encoding in ('gzip', 'deflate'):
+                r = requests.get(self.test_url + "/getData",
+                                 params=dict(params, stream=stream),
+                                 headers={'Accept-Encoding': encoding})
+                self.assertEquals(encoding, r.headers['Content-Encoding'])
+                self.assertEquals(plain.content, r.content)
+        # A 304 carries the weak ETag the encoded 200 had.
+        self.assertTrue(r.headers['ETag'].startswith('W/'))
+        r2 = requests.get(self.test_url + "/getData", params=params,
+                          headers={'Accept-Encoding': 'deflate',
+                                   'If-None-Match': r.headers['ETag']})
+        self.assertEquals(304, r2.status_code)
+        self.assertEquals(r.headers['ETag'], r2.headers['ETag'])
+
+    def testStats(self):
+        params = {
+            "stn": 'nnsc',
+            "sD": '2011-12-1',
+            "eD": '2012-1-31',
+            "elements": 'AVA',
+        }
+        r = self.make_request("/getStats", params)
+        self.assertEquals(['AVA'], r["data"].keys())
+        self.assertEquals(set(stats.STATS), set(r["data"]["AVA"]))
+        r = self.make_request("/getStats", dict(params, elements='FOO'))
+        self.assertTrue("error" in r)
+
+    def testMetrics(self):
+        self.make_request("/getStnDates", {"stn": 'nnsc'})
+        r = requests.get(self.test_url + "/metrics")
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        self.assertTrue('wea_requests_total{endpoint="getStnDates",'
+                        'status="200"}' in r.content)
+
     def testAllNativeArgs(self):
         r = self.make_request("/getData")
         self.assertTrue("error" in r)
@@ -453,6 +1479,54 @@ class ServiceTest(TestCase):
         degF = r["data"]["AVA"]
 
 
+class ElementsTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sources = []
+        for filename in elements.source_files():
+            copy = os.path.join(self.dir, os.path.basename(filename))
+            shutil.copy(filename, copy)
+            self.sources.append(copy)
+        self.snapshot = os.path.join(self.dir, 'elements.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testSnapshot(self):
+        parsed = elements.load_tables(self.sources, self.snapshot)
+        self.assertTrue(os.path.exists(self.snapshot))
+        self.assertEquals(parsed,
+                          elements.load_tables(self.sources, self.snapshot))
+        self.assertEquals(dict(WeaElements), parsed[0])
+        self.assertEquals((1.8, 32.0, 'Deg F'), parsed[1][('Deg C', 'E')])
+
+    def testNoSnapshot(self):
+        snapshot = getattr(settings, 'ELEMENTS_SNAPSHOT', None)
+        settings.ELEMENTS_SNAPSHOT = None
+        try:
+            parsed = elements.load_tables(self.sources)
+        finally:
+            settings.ELEMENTS_SNAPSHOT = snapshot
+        self.assertEquals(dict(WeaElements), parsed[0])
+        self.assertEquals(sorted(map(os.path.basename, self.sources)),
+                          sorted(os.listdir(self.dir)))
+        elements.load_tables(self.sources, self.snapshot)
+        self.assertEquals(len(self.sources) + 1, len(os.listdir(self.dir)))
+
+    def testRebuilt(self):
+        elements.load_tables(self.sources, self.snapshot)
+        with open(self.sources[2], 'a') as f:
+            f.write('E,Foo,Bar,2,0\n')
+        os.utime(self.sources[2], (0, 0))
+        conversions = elements.load_tables(self.sources, self.snapshot)[1]
+        self.assertEquals((2.0, 0.0, 'Bar'), conversions[('Foo', 'E')])
+
+    def testLazy(self):
+        self.assertTrue('AVA' in WeaElements)
+        self.assertFalse('FooBar' in WeaElements)
+        self.assertEquals(None, WeaElements.get('FooBar'))
+
+
 class ConversionsTest(TestCase):
     def setUp(self):
         pass